@@ -25,7 +25,7 @@ Vague plan of cool things
 * rivers (done)
 * secret doors (done)
 * cavernous corridors should have some erosion, and not be straight
-* DM toolpanel in TTS, including button to delete everything.
+* DM toolpanel in TTS, including button to delete everything. (done)
 * Prepared wandering monster encounters in the DM hidden zone (also relevant for traps that summon)
 * More special rooms, such as with altars
 * Boss fights / boss rooms?
@@ -67,6 +67,14 @@ class DungeonConfig:
         self.add_var("encounter_xp_low_percent", 50.0)
         self.add_var("encounter_xp_high_percent", 200.0)
         self.add_var("monster_filter", "Undead or Flesh Golem", is_long=True)
+        self.add_var(
+            "encounter_solver",
+            "random",
+            combobox_values=["random", "dp"],
+            is_long=True,
+        )
+        self.add_var("encounter_pool_size", 0, in_biome=False)
+        self.add_var("encounter_workers", 1, in_biome=False)
         self.add_var("trap_damage_low_multiplier", 3)
         self.add_var("trap_damage_high_multiplier", 5)
         self.add_var("room_trap_percent", 30.0)
@@ -82,10 +90,33 @@ class DungeonConfig:
         self.add_var("tts_fog_of_war", False, in_biome=False)
         self.add_var("tts_hidden_zones", True, in_biome=False)
         self.add_var("tts_notecards", True, in_biome=False)
+        self.add_var("tts_merge_floor_tiles", False, in_biome=False)
+        self.add_var("tts_combined_meshes", False, in_biome=False)
+        self.add_var("tts_incremental_export", False, in_biome=False)
+        self.add_var("tts_compact_encoding", False, in_biome=False)
+        self.add_var("tts_transform_digits", 3, in_biome=False)
+        self.add_var("tts_lua_spawner", False, in_biome=False)
+        self.add_var("tts_export_workers", 1, in_biome=False)
+        self.add_var(
+            "tts_interior_walls",
+            "keep",
+            combobox_values=["keep", "cull", "backdrop"],
+            is_long=True,
+            in_biome=False,
+        )
         self.allow_corridor_intersection = False
         self.max_corridor_attempts = 30000
         self.max_room_attempts = 10
 
+    def __getstate__(self):
+        # Tk widgets and variables can't be pickled, e.g. to hand a
+        # floor to worker processes; their values are in __dict__.
+        state = dict(self.__dict__)
+        state["tk_labels"] = {}
+        state["tk_entries"] = {}
+        state["tk_vars"] = {}
+        return state
+
     def add_var(
         self,
         k,
@@ -13,6 +13,7 @@ from lib.monster import Monster, get_monster_library
 from lib.rivers import River
 from lib.room import CavernousRoom, MazeJunction, RectRoom, Room
 from lib.tile import (
+    WALL_MASK_NEIGHBORS,
     BookshelfTile,
     ChestTile,
     CorridorFloorTile,
@@ -76,6 +77,12 @@ class DungeonFloor:
         # a graph of rooms' neighbors, from room index to set of
         # neighbors' room indices.
         self.room_neighbors = collections.defaultdict(set)
+        # what the last incremental TTS export emitted, see
+        # lib.tts.dungeon_to_tts_blob
+        self.tts_export_id = None
+        self.tts_manifest = None
+        # see wall_masks; dropped whenever a tile is set
+        self._wall_masks = None
 
     def tts_xz(self, x, y, tts_transform=None, diameter=1):
         tts_x = x - math.floor(self.width / 2.0) + 0.5
@@ -124,8 +131,34 @@ class DungeonFloor:
         assert tile.y >= 0
         assert tile.y <= self.height
         self.tiles[tile.x][tile.y] = tile
+        self._wall_masks = None
         return tile
 
+    def wall_masks(self):
+        """wall_masks()[x][y] has bit i set if the tile offset by
+        WALL_MASK_NEIGHBORS[i] from (x, y) is a wall. Anything off the
+        map counts as wall."""
+        if self._wall_masks is None:
+            # walls[x + 1][y + 1], with a border of walls around the map
+            border = [True] * (self.height + 2)
+            walls = [border]
+            for column in self.tiles:
+                walls.append(
+                    [True] + [isinstance(t, WallTile) for t in column] + [True]
+                )
+            walls.append(border)
+            masks = [[0] * self.height for _ in range(self.width)]
+            for bit, (dx, dy) in enumerate(WALL_MASK_NEIGHBORS):
+                for x in range(self.width):
+                    neighbors = walls[x + 1 + dx][
+                        1 + dy : self.height + 1 + dy
+                    ]
+                    masks[x] = [
+                        m | (w << bit) for m, w in zip(masks[x], neighbors)
+                    ]
+            self._wall_masks = masks
+        return self._wall_masks
+
     def get_tile(self, x, y, default=None):
         if x < 0 or x >= self.width or y < 0 or y >= self.height:
             if default is None:
@@ -1039,6 +1072,8 @@ def place_treasure_in_biome(df, biome, rooms, lib, mimic_info):
     eligible_room_weights = []
     bookshelf_rooms = []
     bookshelf_room_weights = []
+    chests = []
+    bookshelves = []
     for room in rooms:
         if not room.allows_treasure(df):
             continue
@@ -1063,16 +1098,9 @@ def place_treasure_in_biome(df, biome, rooms, lib, mimic_info):
         if not coords:
             continue
         x, y = coords
-        contents = lib.gen_horde(
-            biome.target_character_level,
-            biome.num_player_characters,
-        )
-        if not contents:
-            contents = ["Nothing!"]
-        new_tile = ChestTile(
-            room.ix, biome_name=room.biome_name, contents="\n".join(contents)
-        )
+        new_tile = ChestTile(room.ix, biome_name=room.biome_name)
         df.set_tile(new_tile, x=x, y=y)
+        chests.append(new_tile)
         num_treasures += 1
     for _ in range(target_num_mimics * 10):
         if not eligible_rooms or num_mimics >= target_num_mimics:
@@ -1099,17 +1127,18 @@ def place_treasure_in_biome(df, biome, rooms, lib, mimic_info):
         if not coords:
             continue
         x, y = coords
-        contents = lib.gen_bookshelf_horde(
-            biome.target_character_level,
-            biome.num_player_characters,
-        )
-        if not contents:
-            contents = ["Nothing!"]
-        new_tile = BookshelfTile(
-            room.ix, biome_name=room.biome_name, contents="\n".join(contents)
-        )
+        new_tile = BookshelfTile(room.ix, biome_name=room.biome_name)
         df.set_tile(new_tile, x=x, y=y)
+        bookshelves.append(new_tile)
         num_bookshelves += 1
+    # Fill them all at once, which is quicker than one at a time.
+    party = (biome.target_character_level, biome.num_player_characters)
+    for tile, contents in zip(chests, lib.gen_hordes([party] * len(chests))):
+        tile.contents = "\n".join(contents or ["Nothing!"])
+    for tile, contents in zip(
+        bookshelves, lib.gen_bookshelf_hordes([party] * len(bookshelves))
+    ):
+        tile.contents = "\n".join(contents or ["Nothing!"])
 
 
 def place_monsters_in_dungeon(df):
@@ -1122,16 +1151,52 @@ def place_monsters_in_dungeon(df):
         place_monsters_in_biome(df, biome, rooms, monster_counts)
 
 
-def place_monsters_in_biome(df, biome, rooms, monster_counts):
-    max_cr = int(math.ceil(biome.target_character_level * 7.0 / 5.0))
-    monster_infos = get_monster_library("dnd 5e monsters").get_monster_infos(
+def _biome_max_cr(biome):
+    return int(math.ceil(biome.target_character_level * 7.0 / 5.0))
+
+
+def _biome_monster_infos(biome):
+    return get_monster_library("dnd 5e monsters").get_monster_infos(
         filter=biome.monster_filter,
-        max_challenge_rating=max_cr,
+        max_challenge_rating=_biome_max_cr(biome),
         has_tts=True,
     )
+
+
+def _room_target_xp(biome, monster_infos):
+    lowest_monster_xp = min((m.xp for m in monster_infos if m.xp))
+    lo = biome.encounter_xp_low_percent
+    hi = biome.encounter_xp_high_percent
+    xp_percent_of_medium = lo + random.random() * abs(hi - lo)
+    return max(
+        round(lib.monster.med_target_xp(biome) * xp_percent_of_medium * 0.01),
+        lowest_monster_xp,
+    )
+
+
+def _place_encounter(df, room, encounter):
+    room.encounter = encounter
+    monsters = list(encounter.monsters)
+    random.shuffle(monsters)
+    monsters.sort(key=lambda m: -m.monster_info.xp)
+    for monster in monsters:
+        tile_coords = room.pick_tile(
+            df,
+            unoccupied=True,
+            diameter=monster.monster_info.diameter,
+        )
+        if not tile_coords:
+            continue
+        monster.x, monster.y = tile_coords
+        monster.roomix = room.ix
+        df.add_monster(monster)
+
+
+def place_monsters_in_biome(df, biome, rooms, monster_counts):
+    max_cr = _biome_max_cr(biome)
+    monster_infos = _biome_monster_infos(biome)
     if not monster_infos:
         return  # no monsters matched whatever filters
-    lowest_monster_xp = min((m.xp for m in monster_infos if m.xp))
     num_monster_encounters = 0
     target_monster_encounters = round(
         len(rooms) * biome.room_encounter_percent / 100.0
@@ -1143,50 +1208,94 @@ def place_monsters_in_biome(df, biome, rooms, monster_counts):
     random.shuffle(roomixs)
     roomixs = roomixs[:target_monster_encounters]
     roomixs.sort(key=lambda ix: df.rooms[ix].total_space())
+
+    def room_target_xp():
+        return _room_target_xp(biome, monster_infos)
+
     encounters = []
-    for roomix in roomixs:
-        lo = biome.encounter_xp_low_percent
-        hi = biome.encounter_xp_high_percent
-        xp_percent_of_medium = lo + random.random() * abs(hi - lo)
-        target_xp = max(
-            round(
-                lib.monster.med_target_xp(biome) * xp_percent_of_medium * 0.01
-            ),
-            lowest_monster_xp,
-        )
-        enc = lib.monster.build_encounter(
+    if df.config.encounter_workers > 1 and df.config.encounter_pool_size <= 0:
+        encounters = lib.monster.build_encounters_in_parallel(
             monster_infos,
-            target_xp,
-            prev_monster_counts=monster_counts,
-            max_space=df.rooms[roomix].total_space(),
+            [
+                (room_target_xp(), df.rooms[roomix].total_space())
+                for roomix in roomixs
+            ],
+            monster_counts,
+            solver=biome.encounter_solver,
+            workers=df.config.encounter_workers,
         )
-        if not enc.monsters:
-            continue
-        for m in enc.monsters:
-            monster_counts[m.monster_info.name] += 1
-        encounters.append(enc)
+        encounters = [enc for enc in encounters if enc.monster_infos]
+    else:
+        for roomix in roomixs:
+            target_xp = room_target_xp()
+            if df.config.encounter_pool_size > 0:
+                pool = get_monster_library(
+                    "dnd 5e monsters"
+                ).get_encounter_pool(
+                    biome.monster_filter,
+                    max_cr,
+                    target_xp,
+                    df.rooms[roomix].total_space(),
+                    solver=biome.encounter_solver,
+                    size=df.config.encounter_pool_size,
+                )
+                enc = pool.draw(target_xp, monster_counts)
+            else:
+                enc = lib.monster.build_encounter(
+                    monster_infos,
+                    target_xp,
+                    prev_monster_counts=monster_counts,
+                    max_space=df.rooms[roomix].total_space(),
+                    solver=biome.encounter_solver,
+                )
+            if not enc.monsters:
+                continue
+            for m in enc.monsters:
+                monster_counts[m.monster_info.name] += 1
+            encounters.append(enc)
     encounters.sort(key=lambda e: e.total_space())
 
     for roomix, encounter in zip(roomixs, encounters):
-        room = df.rooms[roomix]
-        room.encounter = encounter
-        monsters = list(encounter.monsters)
-        random.shuffle(monsters)
-        monsters.sort(key=lambda m: -m.monster_info.xp)
-        for monster in monsters:
-            tile_coords = room.pick_tile(
-                df,
-                unoccupied=True,
-                diameter=monster.monster_info.diameter,
-            )
-            if not tile_coords:
-                continue
-            monster.x, monster.y = tile_coords
-            monster.roomix = roomix
-            df.add_monster(monster)
+        _place_encounter(df, df.rooms[roomix], encounter)
         num_monster_encounters += 1
 
 
+def reroll_room_encounter(df, room):
+    """Replaces a room's encounter, if it may have one, with a new one
+    built as place_monsters_in_biome would, counting the rest of the
+    floor's monsters against max_per_floor. Returns the new encounter,
+    or None if there's none.
+
+    Exporting the floor again with tts_incremental_export then only
+    replaces the room's objects."""
+    if not room.allows_enemies(df):
+        return None
+    biome = df.config.get_biome(room.biome_name)
+    monster_infos = _biome_monster_infos(biome)
+    if not monster_infos:
+        return None
+    others = [m for m in df.monsters if m.roomix != room.ix]
+    df.monsters = []
+    df.monster_locations = {}
+    for monster in others:
+        df.add_monster(monster)
+    room.encounter = None
+    monster_counts = collections.defaultdict(int)
+    for monster in df.monsters:
+        monster_counts[monster.monster_info.name] += 1
+    encounter = lib.monster.build_encounter(
+        monster_infos,
+        _room_target_xp(biome, monster_infos),
+        prev_monster_counts=monster_counts,
+        max_space=room.total_space(),
+        solver=biome.encounter_solver,
+    )
+    if not encounter.monsters:
+        return None
+    _place_encounter(df, room, encounter)
+    return encounter
+
+
 def place_traps_in_dungeon(df):
     for room in df.rooms:
         if not room.allows_traps(df):
@@ -285,8 +285,7 @@ class Altar(SpecialFeature):
         color_muls = self.deity.tts_tile_tint
         if not color_muls:
             return
-        ref_floor = tts.reference_object("Floor, Dungeon")
-        ref_mesh = ref_floor["CustomMesh"]["MeshURL"]
+        ref_mesh = tts.reference_mesh_url("Floor, Dungeon")
         for o in tts.recurse_object(obj):
             if o.get("CustomMesh", {}).get("MeshURL") == ref_mesh:
                 for k in "rgb":
@@ -0,0 +1,215 @@
+"""
+Static dungeon geometry baked into combined Wavefront OBJ meshes, so
+that Tabletop Simulator loads a few dozen custom models instead of
+thousands of floor and wall tiles.
+
+OBJ format reference:
+https://paulbourke.net/dataformats/obj/
+"""
+
+import os
+import shutil
+
+import lib.tts as tts
+from lib.utils import COC_ROOT_DIR
+
+_WALL_HEIGHT = 2.0
+_ROCK_CHUNK_SIZE = 16
+
+
+class ObjMesh:
+    def __init__(self):
+        self.vertices = []
+        self.vertex_ixs = {}  # (x, y, z) -> 1-based index
+        self.uvs = []
+        self.uv_ixs = {}  # (u, v) -> 1-based index
+        self.triangles = []  # [((vix, uvix), (vix, uvix), (vix, uvix))]
+
+    def _ix(self, item, items, ixs):
+        ix = ixs.get(item)
+        if ix is None:
+            items.append(item)
+            ix = len(items)
+            ixs[item] = ix
+        return ix
+
+    def add_quad(self, corners, uvs, outward):
+        """Adds a quad given its corners in order around its edge.
+
+        The winding is fixed up so the quad faces the outward
+        direction, as OBJ expects counterclockwise front faces."""
+        (ax, ay, az), (bx, by, bz), (cx, cy, cz) = corners[:3]
+        ux, uy, uz = bx - ax, by - ay, bz - az
+        vx, vy, vz = cx - ax, cy - ay, cz - az
+        normal = (uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx)
+        if sum(n * o for n, o in zip(normal, outward)) < 0:
+            corners = corners[::-1]
+            uvs = uvs[::-1]
+        points = [
+            (
+                self._ix(p, self.vertices, self.vertex_ixs),
+                self._ix(uv, self.uvs, self.uv_ixs),
+            )
+            for p, uv in zip(corners, uvs)
+        ]
+        self.triangles.append((points[0], points[1], points[2]))
+        self.triangles.append((points[0], points[2], points[3]))
+
+    def write(self, filename):
+        lines = []
+        for x, y, z in self.vertices:
+            lines.append(f"v {x:g} {y:g} {z:g}")
+        for u, v in self.uvs:
+            lines.append(f"vt {u:g} {v:g}")
+        for triangle in self.triangles:
+            lines.append("f " + " ".join(f"{v}/{t}" for v, t in triangle))
+        with open(filename, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def _region_key(df, x, y):
+    """Which room, corridor or chunk of rock a tile's geometry joins."""
+    tiles = [df.tiles[x][y]]
+    if tiles[0].is_wall():
+        tiles += [
+            t
+            for t in df.neighbor_tiles(x, y, diagonal=True)
+            if not t.is_wall()
+        ]
+    for tile in tiles:
+        if tile.roomix is not None:
+            return ("room", tile.roomix)
+    for tile in tiles:
+        if tile.corridorix is not None:
+            return ("corridor", tile.corridorix)
+    return ("rock", x // _ROCK_CHUNK_SIZE, y // _ROCK_CHUNK_SIZE)
+
+
+def _material(obj):
+    mesh = obj["CustomMesh"]
+    color = obj.get("ColorDiffuse", {})
+    return (
+        mesh.get("DiffuseURL", ""),
+        mesh.get("NormalURL", ""),
+        tuple(sorted(color.items())),
+        tts.light_mul(obj),
+    )
+
+
+def combined_mesh_objects(df, name, skip_coords=frozenset()):
+    """Bakes plain floors and walls into one OBJ per region and material.
+
+    Each room or corridor (along with the walls bordering it) is a
+    region, and any remaining rock is chunked into squares. Dungeon
+    walls become simple boxes carrying their tile's texture; cavern
+    walls are left out, as their rounded pieces can't be baked from
+    here. So are interactive tiles such as doors, chests and ladders,
+    tiles with traps, whose GMNotes describe them, and anything in
+    skip_coords. Only tiles with the same GMNotes are baked together,
+    so every baked tile's notes are its mesh's. Meshes left in the output directory
+    by an earlier export of the same name are removed. Returns the
+    custom model objects and the set of (x, y) baked."""
+    feature_coords = set()
+    for feature in df.special_features:
+        for x, y, _ in feature.ascii_chars(df):
+            feature_coords.add((x, y))
+    # (region key, kind, material, GMNotes) -> [template object, [(x, y)]]
+    groups = {}
+    for x in range(df.width):
+        for y in range(df.height):
+            if (x, y) in skip_coords or (x, y) in feature_coords:
+                continue
+            tile = df.tiles[x][y]
+            if tile.trapixs:
+                continue
+            if tile.is_wall():
+                if tile.tile_style == "cavern":
+                    continue
+                kind = "wall"
+                obj = tile._wall_tts_object(df)
+            elif tile.floor_slab_key() is not None:
+                kind = "floor"
+                obj = tile._floor_tile_tts_object(df)
+            else:
+                continue
+            key = (
+                _region_key(df, x, y),
+                kind,
+                _material(obj),
+                obj.get("GMNotes", ""),
+            )
+            if key not in groups:
+                groups[key] = [obj, []]
+            groups[key][1].append((x, y))
+    mesh_dir = os.path.join(COC_ROOT_DIR, "output", "meshes", name)
+    shutil.rmtree(mesh_dir, ignore_errors=True)
+    os.makedirs(mesh_dir)
+    objects = []
+    baked_coords = set()
+    for ix, ((_, kind, *_), (obj, coords)) in enumerate(groups.items()):
+        cx = (min(x for x, _ in coords) + max(x for x, _ in coords)) / 2.0
+        cy = (min(y for _, y in coords) + max(y for _, y in coords)) / 2.0
+        mesh = ObjMesh()
+        for x, y in coords:
+            _add_tile_geometry(df, mesh, kind, x, y, x - cx, y - cy)
+        filename = os.path.join(mesh_dir, f"{ix}.obj")
+        mesh.write(filename)
+        if kind == "floor":
+            # The new mesh URL would hide this from finalize_tts_object.
+            color = obj.setdefault("ColorDiffuse", {})
+            for k in "rgb":
+                color[k] = color.get(k, 1.0) * tts.light_mul(obj)
+        tts.set_light_mul(obj, 1.0)
+        obj.pop("States", None)
+        obj.pop("ChildObjects", None)
+        obj["CustomMesh"]["MeshURL"] = f"file:///{filename}"
+        obj["CustomMesh"]["ColliderURL"] = ""
+        # A convex hull of a ring of walls would fill in the room.
+        obj["CustomMesh"]["Convex"] = False
+        obj["Nickname"] = ""
+        obj["Locked"] = True
+        for k in ["rotX", "rotY", "rotZ"]:
+            obj["Transform"][k] = 0.0
+        for k in ["scaleX", "scaleY", "scaleZ"]:
+            obj["Transform"][k] = 1.0
+        df.tts_xz(cx, cy, obj)
+        objects.append(obj)
+        baked_coords.update(coords)
+    return (objects, baked_coords)
+
+
+def _add_tile_geometry(df, mesh, kind, x, y, lx, lz):
+    # TTS mirrors OBJ meshes along X when importing them, so X is
+    # negated here to come out the right way around.
+    def p(dx, h, dz):
+        return (-(lx + dx), h, lz + dz)
+
+    square = [(0, 0), (1, 0), (1, 1), (0, 1)]
+    h = 0.0
+    if kind == "wall":
+        h = _WALL_HEIGHT
+    mesh.add_quad(
+        [p(-0.5, h, -0.5), p(0.5, h, -0.5), p(0.5, h, 0.5), p(-0.5, h, 0.5)],
+        square,
+        (0, 1, 0),
+    )
+    if kind != "wall":
+        return
+    side_uvs = [(0, 0), (1, 0), (1, h), (0, h)]
+    for dx, dz in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+        neighbor = df.get_tile(x + dx, y + dz)
+        if neighbor is None or neighbor.is_wall():
+            continue
+        # the edge of the tile facing (dx, dz), from one end to the other
+        ex, ez = 0.5 * dx, 0.5 * dz
+        sx, sz = 0.5 * dz, 0.5 * dx
+        mesh.add_quad(
+            [
+                p(ex - sx, 0.0, ez - sz),
+                p(ex + sx, 0.0, ez + sz),
+                p(ex + sx, h, ez + sz),
+                p(ex - sx, h, ez - sz),
+            ],
+            side_uvs,
+            (-dx, 0, dz),
+        )
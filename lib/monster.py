@@ -1,6 +1,10 @@
+import argparse
+import bisect
 import collections
+import concurrent.futures
 import copy
 import functools
+import hashlib
 import json
 import math
 import os
@@ -18,7 +22,7 @@ from lib.utils import (
     Doc,
     choice,
     eval_dice,
-    expr_match_keywords,
+    expr_match_bitsets,
     remove_non_ascii,
 )
 
@@ -34,15 +38,93 @@ class MonsterLibrary:
     def __init__(self, name):
         self.name = name
         self.monster_infos = []
+        self.build_indexes()
+
+    def _filename(self, suffix=""):
+        return os.path.join(
+            COC_ROOT_DIR,
+            "reference_info",
+            "monsters",
+            f"{self.name}{suffix}.json",
+        )
 
     def load(self):
-        filename = os.path.join(
-            COC_ROOT_DIR, "reference_info", "monsters", f"{self.name}.json"
+        with open(self._filename(), "rb") as f:
+            text = f.read()
+        blob = json.loads(text)
+        for monster_blob in blob["monsters"]:
+            self.monster_infos.append(MonsterInfo(monster_blob))
+        prebuilt = None
+        try:
+            with open(self._filename(".index")) as f:
+                prebuilt = json.load(f)
+        except OSError:
+            pass
+        if prebuilt is not None:
+            if prebuilt["library_sha256"] != hashlib.sha256(text).hexdigest():
+                prebuilt = None
+        self.build_indexes(prebuilt)
+
+    def build_indexes(self, prebuilt=None):
+        """Indexes monster_infos for get_monster_infos. Call again after
+        changing them.
+
+        Sets of monsters are ints with bit i set for monster_infos[i].
+        prebuilt is an index saved by save_indexes for these same
+        monster_infos, whose bitsets are used rather than worked out."""
+        self.monster_infos = list(self.monster_infos)
+        self.everything = (1 << len(self.monster_infos)) - 1
+        # name or uppercase keyword -> set of monsters
+        self.keyword_bitsets = collections.defaultdict(int)
+        if prebuilt is not None:
+            for keyword, bits in prebuilt["keyword_bitsets"].items():
+                self.keyword_bitsets[keyword] = int(bits, 16)
+        else:
+            for ix, m in enumerate(self.monster_infos):
+                for keyword in [m.name] + m.keywords:
+                    self.keyword_bitsets[keyword.upper()] |= 1 << ix
+        # the monsters with a challenge rating, sorted by it, and
+        # cr_prefix_bitsets[i] the set of the first i of them
+        rated = sorted(
+            (m.challenge_rating, ix)
+            for ix, m in enumerate(self.monster_infos)
+            if m.challenge_rating is not None
         )
-        with open(filename) as f:
-            blob = json.load(f)
-            for monster_blob in blob["monsters"]:
-                self.monster_infos.append(MonsterInfo(monster_blob))
+        self.sorted_challenge_ratings = [cr for cr, _ in rated]
+        self.cr_prefix_bitsets = [0]
+        for _, ix in rated:
+            self.cr_prefix_bitsets.append(
+                self.cr_prefix_bitsets[-1] | (1 << ix)
+            )
+        # Loading the TTS reference save is slow, so left until needed.
+        self.has_tts_bitset = None
+        if prebuilt is not None and prebuilt["has_tts_bitset"] is not None:
+            if prebuilt["tts_reference_stamp"] == tts.reference_save_stamp():
+                self.has_tts_bitset = int(prebuilt["has_tts_bitset"], 16)
+        self.query_cache = {}
+        self.encounter_pools = {}
+
+    def _challenge_rating_bitset(self, min_cr, max_cr):
+        crs = self.sorted_challenge_ratings
+        lo = 0
+        if min_cr is not None:
+            lo = bisect.bisect_left(crs, min_cr)
+        hi = len(crs)
+        if max_cr is not None:
+            hi = bisect.bisect_right(crs, max_cr)
+        if hi <= lo:
+            return 0
+        return self.cr_prefix_bitsets[hi] & ~self.cr_prefix_bitsets[lo]
+
+    def _has_tts_bitset(self):
+        if self.has_tts_bitset is None:
+            self.has_tts_bitset = 0
+            for ix, m in enumerate(self.monster_infos):
+                if m.tts_reference_nicknames or tts.has_reference_object(
+                    m.name
+                ):
+                    self.has_tts_bitset |= 1 << ix
+        return self.has_tts_bitset
 
     def to_blob(self):
         infos = sorted(
@@ -53,12 +135,43 @@ class MonsterLibrary:
             "monsters": [x.to_blob() for x in infos],
         }
 
-    def save(self):
-        filename = os.path.join(
-            COC_ROOT_DIR, "reference_info", "monsters", f"{self.name}.json"
-        )
-        with open(filename, "w") as f:
-            json.dump(self.to_blob(), f, sort_keys=True, indent=2)
+    def save(self, with_indexes=False):
+        """Writes the library, and with_indexes its indexes alongside,
+        so that loading it needn't build them."""
+        text = json.dumps(self.to_blob(), sort_keys=True, indent=2)
+        with open(self._filename(), "w") as f:
+            f.write(text)
+        if with_indexes:
+            self.save_indexes(text)
+
+    def save_indexes(self, library_text):
+        """Writes the indexes that loading library_text would build.
+
+        The TTS half is only written if the reference save is there,
+        and only used while it's unchanged."""
+        by_name = {mi.name: mi for mi in self.monster_infos}
+        self.monster_infos = [
+            by_name[blob["name"]]
+            for blob in json.loads(library_text)["monsters"]
+        ]
+        self.build_indexes()
+        stamp = tts.reference_save_stamp()
+        has_tts_bitset = None
+        if stamp is not None:
+            has_tts_bitset = hex(self._has_tts_bitset())
+        blob = {
+            "library_sha256": hashlib.sha256(
+                library_text.encode("utf-8")
+            ).hexdigest(),
+            "keyword_bitsets": {
+                keyword: hex(bits)
+                for keyword, bits in self.keyword_bitsets.items()
+            },
+            "has_tts_bitset": has_tts_bitset,
+            "tts_reference_stamp": stamp,
+        }
+        with open(self._filename(".index"), "w") as f:
+            json.dump(blob, f, sort_keys=True)
 
     def get_monster_infos(
         self,
@@ -67,100 +180,232 @@ class MonsterLibrary:
         max_challenge_rating=None,
         has_tts=False,
     ):
-        output = []
-        for m in self.monster_infos:
-            if has_tts and not (
-                m.tts_reference_nicknames or tts.has_reference_object(m.name)
+        key = (filter, min_challenge_rating, max_challenge_rating, has_tts)
+        output = self.query_cache.get(key)
+        if output is None:
+            bits = expr_match_bitsets(
+                filter, self.keyword_bitsets, self.everything
+            )
+            if min_challenge_rating is not None or (
+                max_challenge_rating is not None
             ):
-                continue
-            if filter is not None:
-                if not expr_match_keywords(filter, [m.name] + m.keywords):
-                    continue
-            if min_challenge_rating is not None:
-                if (
-                    m.challenge_rating is None
-                    or m.challenge_rating < min_challenge_rating
-                ):
-                    continue
-            if max_challenge_rating is not None:
-                if (
-                    m.challenge_rating is None
-                    or m.challenge_rating > max_challenge_rating
-                ):
-                    continue
-            output.append(m)
-        return output
+                bits &= self._challenge_rating_bitset(
+                    min_challenge_rating, max_challenge_rating
+                )
+            if has_tts:
+                bits &= self._has_tts_bitset()
+            output = []
+            while bits:
+                low_bit = bits & -bits
+                output.append(self.monster_infos[low_bit.bit_length() - 1])
+                bits ^= low_bit
+            self.query_cache[key] = output
+        return list(output)
+
+    def get_encounter_pool(
+        self,
+        filter,
+        max_challenge_rating,
+        target_xp,
+        max_space,
+        solver="random",
+        size=8,
+    ):
+        """The EncounterPool for the monsters matching filter up to
+        max_challenge_rating (with TTS objects), shared by every target
+        XP in the same band and every max space in the same bucket.
+
+        Bands go up by a factor of 2**0.25, and buckets by powers of 2
+        so the pool's encounters fit any space within the bucket."""
+        xp_band = math.floor(math.log2(max(target_xp, 1)) * 4)
+        space_bucket = None
+        if max_space is not None:
+            space_bucket = 0
+            if max_space >= 1:
+                space_bucket = 1 << (int(max_space).bit_length() - 1)
+        key = (filter, max_challenge_rating, xp_band, space_bucket, solver)
+        pool = self.encounter_pools.get(key)
+        if pool is None or pool.size != size:
+            pool = EncounterPool(
+                self.get_monster_infos(
+                    filter=filter,
+                    max_challenge_rating=max_challenge_rating,
+                    has_tts=True,
+                ),
+                round(2 ** ((xp_band + 0.5) / 4)),
+                space_bucket,
+                solver,
+                size,
+            )
+            self.encounter_pools[key] = pool
+        return pool
 
     def ingest_5e_tools_json(self, filename):
+        self.ingest_5e_tools_files([filename])
+
+    def ingest_5e_tools_files(self, filenames, workers=1):
+        """Merges monsters from 5e.tools bestiary files into the library.
+
+        Files are read in workers processes, streaming each so only
+        its parsed monsters are held in memory. Monsters are merged by
+        name in order of files and then position within a file, later
+        ones overriding stats and adding keywords, so the result doesn't
+        depend on which worker finishes first."""
         infos = collections.defaultdict(MonsterInfo)
         for mi in self.monster_infos:
             infos[mi.name] = mi
-        others = []
-        with open(filename) as f:
-            blob = json.load(f)
-            others = blob["monster"]
-        for m in others:
-            if "hp" not in m:
-                continue
-            name = remove_non_ascii(m["name"])
-            mi = infos[name]
-            mi.name = name
-            mi.health = m["hp"]["average"]
-            mi.hit_dice_formula = m["hp"]["formula"]
-            mi.size = {
-                "T": "tiny",
-                "S": "small",
-                "M": "medium",
-                "L": "large",
-                "H": "huge",
-                "G": "gargantuan",
-            }[m.get("size", ["M"])[0]]
-            cr = None
-            if "cr" in m:
-                tmp = m["cr"]
-                if isinstance(tmp, dict):
-                    tmp = tmp.get("cr")
-                if tmp == "1/2":
-                    cr = 0.5
-                elif tmp == "1/4":
-                    cr = 0.25
-                elif tmp == "1/8":
-                    cr = 0.125
-                elif tmp and tmp.isdigit():
-                    cr = int(tmp)
-            if cr is not None:
-                mi.challenge_rating = cr
-            # keywords
-            keywords = set(mi.keywords)
-            if "spellcasting" in m:
-                keywords.add("Spellcaster")
-            if "type" in m:
-                tmp = m["type"]
-                if isinstance(tmp, dict):
-                    keywords.add(tmp["type"])
-                    for tag in tmp.get("tags", []):
-                        if tag.lower() == "orc":
-                            tag = "Orcoid"
-                        if tag.lower() == "kobold":
-                            tag = "Koboldoid"
-                        keywords.add(tag)
-                elif isinstance(tmp, str):
-                    keywords.add(tmp)
-            for sense in m.get("senses", []):
-                keywords.add(sense.split()[0])
-            for environment in m.get("environment", []):
-                keywords.add(environment)
-            for k in m.get("speed", {}).keys():
-                if k == "burrow":
-                    keywords.add("Burrowing")
-                if k == "climb":
-                    keywords.add("Climbing")
-                if k == "fly":
-                    keywords.add("Flying")
-                if k == "swim":
-                    keywords.add("Swimming")
-            mi.keywords = sorted({a.title() for a in keywords})
+        if workers > 1 and len(filenames) > 1:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            ) as pool:
+                file_records = list(pool.map(_read_5e_tools_file, filenames))
+        else:
+            file_records = [_read_5e_tools_file(f) for f in filenames]
+        for records in file_records:
+            for name, stats, cr, keywords in records:
+                mi = infos[name]
+                mi.name = name
+                mi.health, mi.hit_dice_formula, mi.size = stats
+                if cr is not None:
+                    mi.challenge_rating = cr
+                mi.keywords = sorted(
+                    {a.title() for a in set(mi.keywords) | set(keywords)}
+                )
         self.monster_infos = infos.values()
+        self.build_indexes()
+
+
+class _JSONStream:
+    """Reads JSON values one at a time from a file, a chunk at a time."""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """The next non-whitespace character, or "" at the end."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos : self.pos + 1]
+            self._fill()
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError(f"Expected {c!r} at {self.f.name}")
+        self.pos += 1
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            # A number at the end of the buffer may carry on past it.
+            if end == len(self.buf) and not self.eof:
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+
+def _iter_5e_tools_monsters(filename, chunk_size=1 << 16):
+    """Yields the monsters in a 5e.tools bestiary file one by one."""
+    with open(filename, encoding="utf-8") as f:
+        stream = _JSONStream(f, chunk_size)
+        stream.expect("{")
+        while stream.peek() != "}":
+            key = stream.decode()
+            stream.expect(":")
+            if key != "monster":
+                stream.decode()
+            else:
+                stream.expect("[")
+                while stream.peek() != "]":
+                    yield stream.decode()
+                    if stream.peek() == ",":
+                        stream.expect(",")
+                stream.expect("]")
+            if stream.peek() == ",":
+                stream.expect(",")
+
+
+def _read_5e_tools_file(filename):
+    """The monsters in a bestiary file, as (name, (health, hit dice
+    formula, size), challenge rating or None, keywords) tuples."""
+    records = []
+    for m in _iter_5e_tools_monsters(filename):
+        if "hp" not in m:
+            continue
+        name = remove_non_ascii(m["name"])
+        size = {
+            "T": "tiny",
+            "S": "small",
+            "M": "medium",
+            "L": "large",
+            "H": "huge",
+            "G": "gargantuan",
+        }[m.get("size", ["M"])[0]]
+        stats = (m["hp"]["average"], m["hp"]["formula"], size)
+        cr = None
+        if "cr" in m:
+            tmp = m["cr"]
+            if isinstance(tmp, dict):
+                tmp = tmp.get("cr")
+            if tmp == "1/2":
+                cr = 0.5
+            elif tmp == "1/4":
+                cr = 0.25
+            elif tmp == "1/8":
+                cr = 0.125
+            elif tmp and tmp.isdigit():
+                cr = int(tmp)
+        # keywords
+        keywords = set()
+        if "spellcasting" in m:
+            keywords.add("Spellcaster")
+        if "type" in m:
+            tmp = m["type"]
+            if isinstance(tmp, dict):
+                keywords.add(tmp["type"])
+                for tag in tmp.get("tags", []):
+                    if tag.lower() == "orc":
+                        tag = "Orcoid"
+                    if tag.lower() == "kobold":
+                        tag = "Koboldoid"
+                    keywords.add(tag)
+            elif isinstance(tmp, str):
+                keywords.add(tmp)
+        for sense in m.get("senses", []):
+            keywords.add(sense.split()[0])
+        for environment in m.get("environment", []):
+            keywords.add(environment)
+        for k in m.get("speed", {}).keys():
+            if k == "burrow":
+                keywords.add("Burrowing")
+            if k == "climb":
+                keywords.add("Climbing")
+            if k == "fly":
+                keywords.add("Flying")
+            if k == "swim":
+                keywords.add("Swimming")
+        records.append((name, stats, cr, sorted(keywords)))
+    return records
 
 
 _CR_TO_HP_RATIO = {
@@ -360,32 +605,66 @@ class Monster:
 
 
 class Encounter:
+    """A group of monsters, keeping running totals so that monsters can
+    be added and removed cheaply while it's being built. The Monsters
+    themselves, which roll their hit points, are only made once the
+    monsters property is used."""
+
     def __init__(self, monsters=None):
-        self.monsters = monsters or []
+        self.monster_infos = []
+        self._monsters = []  # for monster_infos[:len(self._monsters)]
+        self.xp_sum = 0
+        self.space = 0
+        self.cr_counts = collections.Counter()  # challenge rating -> count
+        for monster in monsters or []:
+            self.add(monster.monster_info)
+            self._monsters.append(monster)
+
+    @property
+    def monsters(self):
+        for mi in self.monster_infos[len(self._monsters) :]:
+            self._monsters.append(Monster(mi))
+        return self._monsters
+
+    def add(self, mi):
+        self.monster_infos.append(mi)
+        self.xp_sum += mi.xp
+        self.space += mi.diameter**2
+        self.cr_counts[mi.challenge_rating] += 1
+
+    def pop(self):
+        """Removes the monster added last, returning its info."""
+        mi = self.monster_infos.pop()
+        del self._monsters[len(self.monster_infos) :]
+        self.xp_sum -= mi.xp
+        self.space -= mi.diameter**2
+        self.cr_counts[mi.challenge_rating] -= 1
+        if not self.cr_counts[mi.challenge_rating]:
+            del self.cr_counts[mi.challenge_rating]
+        return mi
 
     def total_xp(self):
-        tmp_sum = sum([m.monster_info.xp for m in self.monsters])
+        if not self.cr_counts:
+            return 0
         # Count up the monsters, but monsters significantly lower CR
         # don't count as much. I'm attenuating by the square root of
         # the difference in CR minus 1, so 2 CR difference doesn't
         # change things, but going lower than that counds for a good
         # deal less.
-        hi_cr = max([m.monster_info.challenge_rating for m in self.monsters])
+        hi_cr = max(self.cr_counts)
         count = 0.0
-        for m in self.monsters:
+        for cr, num in self.cr_counts.items():
             dcount = 1.0
-            if m.monster_info.challenge_rating < hi_cr - 2:
-                dcount /= math.sqrt(
-                    hi_cr - 1 - m.monster_info.challenge_rating
-                )
-            count += dcount
+            if cr < hi_cr - 2:
+                dcount /= math.sqrt(hi_cr - 1 - cr)
+            count += num * dcount
         # sqrt approximates the table from the DMG for modifying
         # difficulty with multiple monsters. This does not yet ignore
         # monsters with substantially lowered CR.
-        return int(tmp_sum * math.sqrt(count))
+        return int(self.xp_sum * math.sqrt(count))
 
     def total_space(self):
-        return sum([m.monster_info.diameter**2 for m in self.monsters])
+        return self.space
 
     def description(self, df):
         xp = self.total_xp()
@@ -419,13 +698,12 @@ def _build_encounter_single_attempt(
     removable_monster_infos = list(monster_infos)
     monster_freqs = [m.frequency for m in monster_infos]
     for _ in range(100):
-        if len(encounter.monsters) >= variety or len(used_infos) >= len(
+        if len(encounter.monster_infos) >= variety or len(used_infos) >= len(
             monster_infos
         ):
             break
-        ix, mi = choice(
-            list(enumerate(removable_monster_infos)), monster_freqs
-        )
+        ix = choice(range(len(removable_monster_infos)), monster_freqs)
+        mi = removable_monster_infos[ix]
         used_infos[mi.name] = mi
         del removable_monster_infos[ix]
         del monster_freqs[ix]
@@ -437,7 +715,7 @@ def _build_encounter_single_attempt(
         if max_space is not None:
             if encounter.total_space() + mi.diameter**2 > max_space:
                 continue
-        encounter.monsters.append(Monster(mi))
+        encounter.add(mi)
         new_xp = encounter.total_xp()
         if abs(target_xp - new_xp) < abs(target_xp - prev_xp):
             eligible_monsters.append(mi.name)
@@ -445,15 +723,14 @@ def _build_encounter_single_attempt(
             prev_xp = new_xp
             monster_counts[mi.name] += 1
         else:
-            encounter.monsters.pop()
+            encounter.pop()
     for _ in range(100):
         if not eligible_monsters:
             break
-        ix, name = choice(
-            list(enumerate(eligible_monsters)), eligible_monster_freqs
-        )
+        ix = choice(range(len(eligible_monsters)), eligible_monster_freqs)
+        name = eligible_monsters[ix]
         mi = used_infos[name]
-        encounter.monsters.append(Monster(mi))
+        encounter.add(mi)
         new_xp = encounter.total_xp()
         is_improved = abs(target_xp - new_xp) < abs(target_xp - prev_xp)
         if max_space is not None:
@@ -467,7 +744,7 @@ def _build_encounter_single_attempt(
             prev_xp = new_xp
             monster_counts[name] += 1
         else:
-            encounter.monsters.pop()
+            encounter.pop()
             del eligible_monsters[ix]
             del eligible_monster_freqs[ix]
     return encounter
@@ -478,9 +755,9 @@ def score_encounter(encounter, target_xp, prev_monster_counts):
     score = 1.0 - abs(xp - target_xp) / target_xp
     monster_infos = {}  # name -> info
     monster_counts = collections.defaultdict(int)
-    for m in encounter.monsters:
-        monster_infos[m.monster_info.name] = m.monster_info
-        monster_counts[m.monster_info.name] += 1
+    for mi in encounter.monster_infos:
+        monster_infos[mi.name] = mi
+        monster_counts[mi.name] += 1
     # get a poor score if it's all frontline or all backline.
     all_backline = True
     all_frontline = True
@@ -520,13 +797,150 @@ def score_encounter(encounter, target_xp, prev_monster_counts):
     return score
 
 
+_DP_MAX_PER_TYPE = 20
+_DP_XP_BUCKETS = 100  # per target_xp
+_DP_STATES_PER_BUCKET = 3
+_DP_MAX_XP = 1.5  # times target_xp
+_DP_XP_TOLERANCE = 0.05  # times target_xp
+_DP_TOP_K = 3
+
+
+def _solve_encounter(
+    monster_infos, target_xp, variety, prev_monster_counts, max_space
+):
+    """Builds an encounter by dynamic programming over how many of each
+    monster type to use.
+
+    Types alike in CR, XP, size and how many more the floor allows are
+    interchangeable for total XP and space, so the DP runs over groups
+    of them. Groups are added from the highest CR down, so the first
+    one in an encounter fixes the CR that Encounter.total_xp attenuates
+    against, and total XP can be tracked exactly. Partial encounters
+    are kept per (groups used, total XP bucket), the few smallest in
+    space with distinct XP, up to half again the target XP. The
+    finished ones closest to the target XP each get a type from every
+    group they use, drawn by frequency, and are scored with
+    score_encounter; one of the best few is picked by frequency."""
+    # (CR, XP, diameter, max count) -> [info]
+    groups = collections.defaultdict(list)
+    for mi in monster_infos:
+        if mi.frequency <= 0.0:
+            continue
+        if variety != 1 and mi.has_keyword("Homogenous"):
+            continue
+        max_count = _DP_MAX_PER_TYPE
+        if mi.max_per_floor is not None:
+            max_count = min(
+                max_count, mi.max_per_floor - prev_monster_counts[mi.name]
+            )
+        if max_count <= 0:
+            continue
+        groups[(mi.challenge_rating, mi.xp, mi.diameter, max_count)].append(mi)
+    max_xp = _DP_MAX_XP * target_xp
+    bucket_size = max(1.0, target_xp / _DP_XP_BUCKETS)
+    # (groups used, total XP bucket) ->
+    #     [(space, XP, XP sum, attenuated count, top CR, counts), ...]
+    # sorted by space, where counts is ((group, count), ...)
+    states = {(0, 0): [(0, 0, 0, 0.0, None, ())]}
+    for group in sorted(groups, key=lambda group: -group[0]):
+        cr, mi_xp, diameter, max_count = group
+        new_states = {key: list(bucket) for key, bucket in states.items()}
+        for (num_groups, _), bucket in states.items():
+            if num_groups >= variety:
+                continue
+            for space, _, xp_sum, att_count, hi_cr, counts in bucket:
+                if hi_cr is None:
+                    hi_cr = cr
+                dcount = 1.0
+                if cr < hi_cr - 2:
+                    dcount /= math.sqrt(hi_cr - 1 - cr)
+                for count in range(1, max_count + 1):
+                    new_space = space + count * diameter**2
+                    new_xp_sum = xp_sum + count * mi_xp
+                    new_att_count = att_count + count * dcount
+                    xp = int(new_xp_sum * math.sqrt(new_att_count))
+                    if xp > max_xp:
+                        break
+                    if max_space is not None and new_space > max_space:
+                        break
+                    key = (num_groups + 1, int(xp // bucket_size))
+                    _keep_dp_state(
+                        new_states.setdefault(key, []),
+                        (
+                            new_space,
+                            xp,
+                            new_xp_sum,
+                            new_att_count,
+                            hi_cr,
+                            counts + ((group, count),),
+                        ),
+                    )
+        states = new_states
+    finished = [
+        (abs(xp - target_xp), counts)
+        for bucket in states.values()
+        for _, xp, *_, counts in bucket
+        if counts
+    ]
+    if not finished:
+        return Encounter()
+    closest = min(error for error, _ in finished)
+    scored = []
+    for error, counts in finished:
+        if error > closest + _DP_XP_TOLERANCE * target_xp:
+            continue
+        encounter = Encounter()
+        for group, count in counts:
+            infos = groups[group]
+            mi = choice(infos, weights=[mi.frequency for mi in infos])
+            for _ in range(count):
+                encounter.add(mi)
+        score = score_encounter(encounter, target_xp, prev_monster_counts)
+        if score > 0.0001:
+            scored.append((score, encounter))
+    if not scored:
+        return Encounter()
+    scored.sort(key=lambda x: -x[0])
+    best = [encounter for _, encounter in scored[:_DP_TOP_K]]
+    weights = [
+        score
+        * sum(mi.frequency for mi in e.monster_infos)
+        / len(e.monster_infos)
+        for score, e in scored[:_DP_TOP_K]
+    ]
+    return choice(best, weights=weights)
+
+
+def _keep_dp_state(bucket, state):
+    """Adds state to a bucket of _solve_encounter's partial encounters
+    if it's one of the smallest in space, keeping at most one per XP."""
+    for ix, other in enumerate(bucket):
+        if other[1] == state[1]:
+            if state[0] < other[0]:
+                bucket[ix] = state
+                bucket.sort(key=lambda x: x[0])
+            return
+    if len(bucket) < _DP_STATES_PER_BUCKET:
+        bucket.append(state)
+    elif state[0] < bucket[-1][0]:
+        bucket[-1] = state
+    else:
+        return
+    bucket.sort(key=lambda x: x[0])
+
+
 def build_encounter(
     monster_infos,
     target_xp,
     variety=None,
     prev_monster_counts={},
     max_space=None,
+    solver="random",
 ):
+    """Picks monsters worth about target_xp in total.
+
+    The "random" solver keeps the best of 100 random attempts, and the
+    "dp" one uses _solve_encounter."""
     if not variety:
         varieties = [1, 2, 2, 3, 3, 3, 4, 4]
         variety = random.choice(varieties)
@@ -534,6 +948,10 @@ def build_encounter(
         mi for mi in monster_infos if mi.xp and mi.xp <= target_xp * 1.3
     ]
     variety = min(variety, len(monster_infos))
+    if solver == "dp":
+        return _solve_encounter(
+            monster_infos, target_xp, variety, prev_monster_counts, max_space
+        )
     best_encounter = Encounter()
     best_score = 0.0001
     for _ in range(100):
@@ -547,6 +965,147 @@ def build_encounter(
     return best_encounter
 
 
+_worker_monster_infos = None
+
+
+def _init_encounter_worker(monster_infos):
+    global _worker_monster_infos
+    _worker_monster_infos = monster_infos
+
+
+def _build_encounter_task(args):
+    """Builds one room's encounter, returning indexes into the monster
+    infos rather than the infos themselves."""
+    target_xp, max_space, solver, prev_monster_counts, seed = args
+    random.seed(seed)
+    ixs = {id(mi): ix for ix, mi in enumerate(_worker_monster_infos)}
+    encounter = build_encounter(
+        _worker_monster_infos,
+        target_xp,
+        prev_monster_counts=prev_monster_counts,
+        max_space=max_space,
+        solver=solver,
+    )
+    return [ixs[id(mi)] for mi in encounter.monster_infos]
+
+
+def build_encounters_in_parallel(
+    monster_infos, rooms, prev_monster_counts, solver="random", workers=2
+):
+    """Builds an encounter for each (target XP, max space) in rooms,
+    in workers processes.
+
+    Rooms go in waves of one per worker, each built against
+    prev_monster_counts as of the start of its wave, under its own
+    random seed; keeping waves small keeps score_encounter's preference
+    for monsters not yet on the floor about as strong as it is when
+    building them one by one. After each wave the results are taken in
+    order, counting their monsters into prev_monster_counts, and only
+    those that would now go over a monster's max_per_floor are rebuilt,
+    here, against the up to date counts."""
+    encounters = []
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_encounter_worker,
+        initargs=(monster_infos,),
+    ) as pool:
+        for start in range(0, len(rooms), workers):
+            wave = rooms[start : start + workers]
+            tasks = [
+                (
+                    target_xp,
+                    max_space,
+                    solver,
+                    prev_monster_counts,
+                    random.getrandbits(64),
+                )
+                for target_xp, max_space in wave
+            ]
+            results = pool.map(_build_encounter_task, tasks)
+            for (target_xp, max_space), ixs in zip(wave, results):
+                encounter = Encounter()
+                for ix in ixs:
+                    encounter.add(monster_infos[ix])
+                counts = collections.Counter(
+                    mi.name for mi in encounter.monster_infos
+                )
+                if any(
+                    mi.max_per_floor is not None
+                    and counts[mi.name] + prev_monster_counts[mi.name]
+                    > mi.max_per_floor
+                    for mi in encounter.monster_infos
+                ):
+                    encounter = build_encounter(
+                        monster_infos,
+                        target_xp,
+                        prev_monster_counts=prev_monster_counts,
+                        max_space=max_space,
+                        solver=solver,
+                    )
+                for mi in encounter.monster_infos:
+                    prev_monster_counts[mi.name] += 1
+                encounters.append(encounter)
+    return encounters
+
+
+class EncounterPool:
+    """Encounters built for one set of monsters, target XP and max
+    space, drawn from again and again instead of building new ones.
+
+    Each draw builds one more encounter until there are size of them,
+    so the pool costs nothing extra over building encounters directly.
+    The pool's encounters were built without any previous monster
+    counts, so draws are rescored against the current ones, leaving
+    out any that would go over a monster's max_per_floor."""
+
+    def __init__(self, monster_infos, target_xp, max_space, solver, size):
+        self.monster_infos = monster_infos
+        self.target_xp = target_xp
+        self.max_space = max_space
+        self.solver = solver
+        self.size = size
+        self.entries = []  # [[monster info]]
+
+    def draw(self, target_xp, prev_monster_counts):
+        if len(self.entries) < self.size:
+            encounter = build_encounter(
+                self.monster_infos,
+                self.target_xp,
+                prev_monster_counts=collections.defaultdict(int),
+                max_space=self.max_space,
+                solver=self.solver,
+            )
+            if encounter.monster_infos:
+                self.entries.append(encounter.monster_infos)
+        encounters = []
+        weights = []
+        for monster_infos in self.entries:
+            counts = collections.Counter(mi.name for mi in monster_infos)
+            if any(
+                mi.max_per_floor is not None
+                and counts[mi.name] + prev_monster_counts[mi.name]
+                > mi.max_per_floor
+                for mi in monster_infos
+            ):
+                continue
+            encounter = Encounter()
+            for mi in monster_infos:
+                encounter.add(mi)
+            score = score_encounter(encounter, target_xp, prev_monster_counts)
+            if score > 0.0001:
+                encounters.append(encounter)
+                weights.append(score)
+        if not encounters:
+            return build_encounter(
+                self.monster_infos,
+                target_xp,
+                prev_monster_counts=prev_monster_counts,
+                max_space=self.max_space,
+                solver=self.solver,
+            )
+        return choice(encounters, weights=weights)
+
+
 def med_target_xp(config):
     med_xp_per_char = {
         1: 50,
@@ -574,7 +1133,13 @@ def med_target_xp(config):
 
 
 if __name__ == "__main__":
-    ml = get_monster_library("dnd 5e monsters")
-    # ml.ingest_5e_tools_json(r"C:\Users\carl\Downloads\bestiary-vgm.json")
-    # ml.ingest_5e_tools_json(r"C:\Users\carl\Downloads\bestiary-mm.json")
-    ml.save()
+    parser = argparse.ArgumentParser(
+        description="Merges 5e.tools bestiary files into a monster library."
+    )
+    parser.add_argument("bestiaries", nargs="*", help="bestiary JSON files")
+    parser.add_argument("--library", default="dnd 5e monsters")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    ml = get_monster_library(args.library)
+    ml.ingest_5e_tools_files(args.bestiaries, workers=args.workers)
+    ml.save(with_indexes=True)
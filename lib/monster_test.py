@@ -0,0 +1,70 @@
+import collections
+import os
+import random
+import statistics
+import sys
+import unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.append(_ROOT)
+
+import lib.monster as monster
+
+
+def _mean_xp_error(monster_infos, solver, seed):
+    random.seed(seed)
+    errors = []
+    for _ in range(20):
+        target_xp = random.choice([300, 1000, 2500, 5000])
+        max_space = random.choice([4, 9, 16, 40, None])
+        encounter = monster.build_encounter(
+            monster_infos,
+            target_xp,
+            prev_monster_counts=collections.defaultdict(int),
+            max_space=max_space,
+            solver=solver,
+        )
+        errors.append(abs(encounter.total_xp() - target_xp) / target_xp)
+    return statistics.mean(errors)
+
+
+class TestBuildEncounter(unittest.TestCase):
+    def test_dp_as_accurate_as_random(self):
+        library = monster.get_monster_library("dnd 5e monsters")
+        monster_infos = library.get_monster_infos(
+            filter="Undead or Flesh Golem", max_challenge_rating=10
+        )
+        for seed in [1, 2, 3]:
+            self.assertLessEqual(
+                _mean_xp_error(monster_infos, "dp", seed),
+                _mean_xp_error(monster_infos, "random", seed),
+            )
+
+    def test_dp_respects_limits(self):
+        library = monster.get_monster_library("dnd 5e monsters")
+        monster_infos = library.get_monster_infos(max_challenge_rating=10)
+        random.seed(4)
+        for _ in range(20):
+            prev_monster_counts = collections.defaultdict(int)
+            encounter = monster.build_encounter(
+                monster_infos,
+                random.choice([300, 1000, 2500]),
+                variety=2,
+                prev_monster_counts=prev_monster_counts,
+                max_space=9,
+                solver="dp",
+            )
+            self.assertLessEqual(encounter.total_space(), 9)
+            counts = collections.Counter(
+                mi.name for mi in encounter.monster_infos
+            )
+            self.assertLessEqual(len(counts), 2)
+            for mi in encounter.monster_infos:
+                if mi.max_per_floor is not None:
+                    self.assertLessEqual(counts[mi.name], mi.max_per_floor)
+                self.assertFalse(mi.has_keyword("Homogenous"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,4 @@
+import functools
 import random
 import re
 
@@ -20,19 +21,23 @@ class Tile:
         self.biome_name = biome_name
 
     def _tts_light_mul(self, obj):
-        ref = tts.reference_object("Floor, Dungeon")
+        mul = 1.0
+        if self.light_level == "dim":
+            mul = 0.7
+        elif self.light_level == "dark":
+            mul = 0.3
+        # Applied on top of any other tint when the object is finalized.
+        tts.set_light_mul(obj, mul)
+        self._tts_reset_floor_color(obj)
+
+    def _tts_reset_floor_color(self, obj):
         mesh_url = obj.get("CustomMesh", {}).get("MeshURL")
-        if mesh_url == ref["CustomMesh"]["MeshURL"]:
-            mul = 1.0
-            if self.light_level == "dim":
-                mul = 0.7
-            elif self.light_level == "dark":
-                mul = 0.3
-            obj["ColorDiffuse"] = {k: mul for k in "rgb"}
+        if mesh_url == tts.reference_mesh_url("Floor, Dungeon"):
+            obj["ColorDiffuse"] = {k: 1.0 for k in "rgb"}
         for other in obj.get("States", {}).values():
-            self._tts_light_mul(other)
+            self._tts_reset_floor_color(other)
         for other in obj.get("ChildObjects", []):
-            self._tts_light_mul(other)
+            self._tts_reset_floor_color(other)
 
     def to_char(self):
         return "?"
@@ -61,6 +66,10 @@ class Tile:
     def blocks_line_of_sight(self):
         return False
 
+    def floor_slab_key(self):
+        """Tiles with equal non-None keys may share one floor object."""
+        return None
+
     def _alter_tex(self, obj, ref_mesh, new_diffuse, new_normal):
         mesh_url = obj.get("CustomMesh", {}).get("MeshURL")
         if mesh_url == ref_mesh:
@@ -73,12 +82,16 @@ class Tile:
         for other in obj.get("ChildObjects", []):
             self._alter_tex(other, ref_mesh, new_diffuse, new_normal)
 
-    def _update_texture_style(self, obj, df):
+    def _tts_tile_style(self, df):
         tile_style = self.tile_style
         if not tile_style and self.roomix is not None:
             tile_style = df.rooms[self.roomix].tile_style()
         if not tile_style and self.corridorix is not None:
             tile_style = df.corridors[self.corridorix].tile_style()
+        return tile_style
+
+    def _update_texture_style(self, obj, df):
+        tile_style = self._tts_tile_style(df)
         new_floor_diffuse = None
         new_floor_normal = None
         new_wall_diffuse = None
@@ -86,9 +99,12 @@ class Tile:
         biome = df.config.get_biome(self.biome_name)
         if tile_style == "cavern":
             if biome.cavern_style == "cavern":
-                new_floor = tts.reference_object("Floor, Cavern")
-                new_floor_diffuse = new_floor["CustomMesh"]["DiffuseURL"]
-                new_floor_normal = new_floor["CustomMesh"]["NormalURL"]
+                new_floor_diffuse = tts.reference_mesh_url(
+                    "Floor, Cavern", "DiffuseURL"
+                )
+                new_floor_normal = tts.reference_mesh_url(
+                    "Floor, Cavern", "NormalURL"
+                )
             elif biome.cavern_style == "frozen cavern":
                 new_floor_diffuse = "http://cloud-3.steamusercontent.com/ugc/1626318952222096978/830A76F49316CF9F7812562635870D52C315AE6A/"
                 new_floor_normal = ""
@@ -110,8 +126,7 @@ class Tile:
                 new_floor_normal = ""
                 new_wall_diffuse = "http://cloud-3.steamusercontent.com/ugc/1618472276467615219/4469A712823FC698B254395A9FA7C27C39959127/"
         if new_floor_diffuse:
-            ref_floor = tts.reference_object("Floor, Dungeon")
-            ref_mesh = ref_floor["CustomMesh"]["MeshURL"]
+            ref_mesh = tts.reference_mesh_url("Floor, Dungeon")
             self._alter_tex(obj, ref_mesh, new_floor_diffuse, new_floor_normal)
         if new_wall_diffuse:
             refs = [
@@ -125,7 +140,7 @@ class Tile:
                 "Cavern Stalagmites",
             ]
             for ref in refs:
-                ref_mesh = tts.reference_object(ref)["CustomMesh"]["MeshURL"]
+                ref_mesh = tts.reference_mesh_url(ref)
                 self._alter_tex(
                     obj, ref_mesh, new_wall_diffuse, new_wall_normal
                 )
@@ -164,90 +179,143 @@ class Tile:
         self._update_tile_for_features(obj, df)
         obj["GMNotes"] = self._tts_gmnotes(df)
 
-    def _floor_tile_tts_object(self, df):
-        obj = tts.reference_object("Floor, Dungeon")
-        obj["Transform"]["rotY"] = 90.0 * random.randrange(4)
+    def _tts_template_key(self, df):
+        """What _postprocess_tts_object goes by, besides GMNotes."""
+        featureixs = ()
+        if self.roomix is not None:
+            featureixs = tuple(df.rooms[self.roomix].special_featureixs)
+        return (
+            self._tts_tile_style(df),
+            self.biome_name,
+            self.light_level,
+            featureixs,
+        )
+
+    def _tts_object_from_spec(self, df, spec):
+        nickname, rotY = spec
+        obj = tts.reference_object(nickname)
+        obj["Transform"]["rotY"] = rotY
         obj["Nickname"] = ""
         self._postprocess_tts_object(obj, df)
         return obj
 
+    def _tts_templated_from_spec(self, df, spec):
+        posX, posZ = df.tts_xz(self.x, self.y)
+        return (
+            (spec[0], self._tts_template_key(df)),
+            lambda: self._tts_object_from_spec(df, spec),
+            self._tts_gmnotes(df),
+            {"posX": posX, "posZ": posZ, "rotY": spec[1]},
+        )
+
+    def tts_templated_objects(self, df):
+        """tts_objects, for TTSEmitter.emit_templated.
+
+        Returns a list of (template key, build, GMNotes, Transform
+        fields), or None if this tile's objects vary in more than
+        those, in which case tts_objects has to be used."""
+        return None
+
+    def _floor_tile_tts_spec(self):
+        return ("Floor, Dungeon", 90.0 * random.randrange(4))
+
+    def _floor_tile_tts_object(self, df):
+        return self._tts_object_from_spec(df, self._floor_tile_tts_spec())
+
     def _wall_tts_object(self, df):
+        return self._tts_object_from_spec(df, self._wall_tts_spec(df))
+
+    def _wall_tts_spec(self, df):
+        """The reference object and rotY of this tile's wall."""
         if self.tile_style == "cavern":
             # use different wall bits if different adjacent walls
-            def is_neighbor_wall(dx, dy):
-                tx, ty = self.x + dx, self.y + dy
-                return isinstance(df.get_tile(tx, ty, WallTile), WallTile)
-
-            num_diagonal_neighbors = sum(
-                [is_neighbor_wall(dx, dy) for dx in [-1, 1] for dy in [-1, 1]]
-            )
-            west = is_neighbor_wall(-1, 0)
-            east = is_neighbor_wall(1, 0)
-            north = is_neighbor_wall(0, 1)
-            south = is_neighbor_wall(0, -1)
-            num_neighbors = sum([west, east, north, south])
-            rand = random.random()
-            if num_neighbors == 0:
-                obj = tts.reference_object("Cavern Stalagmite Column")
-                obj["Transform"]["rotY"] = 90.0 * random.randrange(4)
-            elif num_neighbors == 1:
-                obj = tts.reference_object("Cavern Wall 1 Connection")
-                if east:
-                    obj["Transform"]["rotY"] = 180.0
-                elif north:
-                    obj["Transform"]["rotY"] = 90.0
-                elif south:
-                    obj["Transform"]["rotY"] = 270.0
-                else:
-                    obj["Transform"]["rotY"] = 0.0
-            elif num_neighbors == 2 and rand < 0.7:
-                if west and east:
-                    obj = tts.reference_object(
-                        "Cavern Wall 2 Connections Through"
-                    )
-                    obj["Transform"]["rotY"] = 0.0 + 180.0 * random.randrange(
-                        2
-                    )
-                elif north and south:
-                    obj = tts.reference_object(
-                        "Cavern Wall 2 Connections Through"
-                    )
-                    obj["Transform"]["rotY"] = 90.0 + 180.0 * random.randrange(
-                        2
-                    )
-                else:
-                    obj = tts.reference_object(
-                        "Cavern Wall 2 Connections Corner"
-                    )
-                    if east and south:
-                        obj["Transform"]["rotY"] = 0.0
-                    if west and south:
-                        obj["Transform"]["rotY"] = 90.0
-                    if west and north:
-                        obj["Transform"]["rotY"] = 180.0
-                    if east and north:
-                        obj["Transform"]["rotY"] = 270.0
-            elif num_neighbors == 3 and (
-                rand < 0.1 or num_diagonal_neighbors >= 3 and rand < 0.8
-            ):
-                obj = tts.reference_object("Cavern Wall 3 Connections")
-                if not west:
-                    obj["Transform"]["rotY"] = 0.0
-                if not north:
-                    obj["Transform"]["rotY"] = 90.0
-                if not east:
-                    obj["Transform"]["rotY"] = 180.0
-                if not south:
-                    obj["Transform"]["rotY"] = 270.0
+            mask = df.wall_masks()[self.x][self.y]
+            nickname, rotYs, chance, diagonal_chance = _CAVERN_WALL_PIECES[
+                mask & 0xF
+            ]
+            if bin(mask >> 4).count("1") >= 3:
+                chance = diagonal_chance
+            if random.random() < chance:
+                rotY = rotYs[0]
+                if len(rotYs) > 1:
+                    rotY = rotYs[random.randrange(len(rotYs))]
             else:
-                obj = tts.reference_object("Cavern Wall Ambiguous Connections")
-                obj["Transform"]["rotY"] = 90.0 * random.randrange(4)
+                nickname = "Cavern Wall Ambiguous Connections"
+                rotY = 90.0 * random.randrange(4)
         else:
-            obj = tts.reference_object("Wall, Dungeon")
-            obj["Transform"]["rotY"] = 90.0 * random.randrange(4)
-        obj["Nickname"] = ""
-        self._postprocess_tts_object(obj, df)
-        return obj
+            nickname = "Wall, Dungeon"
+            rotY = 90.0 * random.randrange(4)
+        return (nickname, rotY)
+
+
+# The (dx, dy) neighbors behind each bit of DungeonFloor.wall_masks:
+# west, east, north and south, then the diagonals.
+WALL_MASK_NEIGHBORS = [
+    (-1, 0),
+    (1, 0),
+    (0, 1),
+    (0, -1),
+    (-1, -1),
+    (1, -1),
+    (-1, 1),
+    (1, 1),
+]
+
+
+def _cavern_wall_pieces():
+    """Maps the low 4 bits of a cavern wall's wall mask to (reference
+    nickname, possible rotYs, chance, chance with 3+ diagonal walls),
+    where a wall not given its piece by chance gets an ambiguous one."""
+    pieces = {}
+    for mask in range(16):
+        west, east, north, south = [bool(mask & (1 << i)) for i in range(4)]
+        num_neighbors = west + east + north + south
+        if num_neighbors == 0:
+            rotYs = (0.0, 90.0, 180.0, 270.0)
+            pieces[mask] = ("Cavern Stalagmite Column", rotYs, 1.0, 1.0)
+        elif num_neighbors == 1:
+            rotY = 0.0
+            if east:
+                rotY = 180.0
+            elif north:
+                rotY = 90.0
+            elif south:
+                rotY = 270.0
+            pieces[mask] = ("Cavern Wall 1 Connection", (rotY,), 1.0, 1.0)
+        elif num_neighbors == 2:
+            if west and east:
+                nickname = "Cavern Wall 2 Connections Through"
+                rotYs = (0.0, 180.0)
+            elif north and south:
+                nickname = "Cavern Wall 2 Connections Through"
+                rotYs = (90.0, 270.0)
+            else:
+                nickname = "Cavern Wall 2 Connections Corner"
+                if east and south:
+                    rotYs = (0.0,)
+                if west and south:
+                    rotYs = (90.0,)
+                if west and north:
+                    rotYs = (180.0,)
+                if east and north:
+                    rotYs = (270.0,)
+            pieces[mask] = (nickname, rotYs, 0.7, 0.7)
+        elif num_neighbors == 3:
+            if not west:
+                rotY = 0.0
+            if not north:
+                rotY = 90.0
+            if not east:
+                rotY = 180.0
+            if not south:
+                rotY = 270.0
+            pieces[mask] = ("Cavern Wall 3 Connections", (rotY,), 0.1, 0.8)
+        else:
+            pieces[mask] = (None, (), 0.0, 0.0)
+    return pieces
+
+
+_CAVERN_WALL_PIECES = _cavern_wall_pieces()
 
 
 class WallTile(Tile):
@@ -267,14 +335,36 @@ class WallTile(Tile):
     def tts_objects(self, df):
         return [self._floor_tile_tts_object(df), self._wall_tts_object(df)]
 
+    def tts_templated_objects(self, df):
+        return [
+            self._tts_templated_from_spec(df, self._floor_tile_tts_spec()),
+            self._tts_templated_from_spec(df, self._wall_tts_spec(df)),
+        ]
+
 
 class FloorTile(Tile):
     def tts_objects(self, df):
         return [self._floor_tile_tts_object(df)]
 
+    def tts_templated_objects(self, df):
+        spec = self._floor_tile_tts_spec()
+        return [self._tts_templated_from_spec(df, spec)]
+
     def is_move_blocking(self):
         return False
 
+    def floor_slab_key(self):
+        if self.riverixs:
+            return None
+        return (
+            self.roomix,
+            self.corridorix,
+            self.tile_style,
+            self.biome_name,
+            self.light_level,
+            tuple(sorted(self.trapixs)),
+        )
+
 
 class RoomFloorTile(FloorTile):
     def __init__(self, roomix, *args, **kwargs):
@@ -312,6 +402,11 @@ class DoorTile(CorridorFloorTile):
     def blocks_line_of_sight(self):
         return True
 
+    def floor_slab_key(self):
+        return None
+
+    tts_templated_objects = Tile.tts_templated_objects
+
     def tts_objects(self, df):
         obj = None
         corridor = df.corridors[self.corridorix]
@@ -366,6 +461,11 @@ class LadderUpTile(RoomFloorTile):
     def to_char(self):
         return "[1;97m<"
 
+    def floor_slab_key(self):
+        return None
+
+    tts_templated_objects = Tile.tts_templated_objects
+
     def tts_objects(self, df):
         obj = tts.reference_object("Ladder, Wood")
         # TODO: adjust such that ladder is against the wall if a wall is near
@@ -385,6 +485,11 @@ class LadderDownTile(RoomFloorTile):
     def to_char(self):
         return "[1;97m>"
 
+    def floor_slab_key(self):
+        return None
+
+    tts_templated_objects = Tile.tts_templated_objects
+
     def tts_objects(self, df):
         obj = tts.reference_object("Floor, Hatch")
         obj["Transform"]["rotY"] = 90.0 * random.randrange(4)
@@ -399,6 +504,43 @@ class LadderDownTile(RoomFloorTile):
         return True
 
 
+_SCROLL_RE = re.compile(r"^[sS]pell [sS]croll \((\d.. [lL]evel|cantrip)\).*$")
+_BOOK_RE = re.compile(r"^[bB]ook: (.+)$")
+_GEM_RE = re.compile(r"^Gemstone \((\d+) gp\): (.*)$")
+_PROTECTION_SCROLL_RE = re.compile("^Scroll of Protection")
+
+
+@functools.cache
+def _tts_contents_reference(line):
+    """What a line of chest contents is in TTS: a Book, or the nickname
+    of the reference object to copy."""
+    m = _BOOK_RE.match(line)
+    if m:
+        return treasure.book_library()[m.groups()[0].strip()]
+    tts_reference_name = line
+    if _PROTECTION_SCROLL_RE.match(line):
+        tts_reference_name = "Reference Scroll Low"
+    m = _SCROLL_RE.match(line)
+    if m:
+        if m.groups()[0] == "cantrip":
+            scroll_level = 0
+        else:
+            scroll_level = int(m.groups()[0][0])
+        if scroll_level < 3:
+            tts_reference_name = "Reference Scroll Low"
+        elif scroll_level < 6:
+            tts_reference_name = "Reference Scroll Medium"
+        else:
+            tts_reference_name = "Reference Scroll High"
+    m = _GEM_RE.match(line)
+    if m:
+        gp, gem = m.groups()
+        tts_reference_name = f"{gem.strip().title()} ({int(gp):,}gp)"
+    if not tts.has_reference_object(tts_reference_name):
+        return "Unknown Object Token"
+    return tts_reference_name
+
+
 def rotY_away_from_wall(df, x, y, original=0):
     posrots = [(0, 1, 0), (1, 0, 90), (0, -1, 180), (-1, 0, 270)]
     random.shuffle(posrots)
@@ -416,6 +558,11 @@ class ChestTile(RoomFloorTile):
     def to_char(self):
         return "[1;93m$"
 
+    def floor_slab_key(self):
+        return None
+
+    tts_templated_objects = Tile.tts_templated_objects
+
     def tts_objects(self, df):
         obj = tts.reference_object("Chest Closed Tile")
         obj["Transform"]["rotY"] += rotY_away_from_wall(df, self.x, self.y)
@@ -446,42 +593,11 @@ class ChestTile(RoomFloorTile):
         ]
 
     def tts_object_from_one_contents(self, line):
-        SCROLL_RE = r"^[sS]pell [sS]croll \((\d.. [lL]evel|cantrip)\).*$"
-        BOOK_RE = r"^[bB]ook: (.+)$"
-        GEM_RE = r"^Gemstone \((\d+) gp\): (.*)$"
-        tts_reference_name = None
-        nickname = None
-        description = None
-        m = re.match(BOOK_RE, line)
-        if m:
-            title = m.groups()[0].strip()
-            book = treasure.book_library()[title]
-            return book.tts_object()
-        if re.match("^Scroll of Protection", line):
-            tts_reference_name = "Reference Scroll Low"
-        m = re.match(SCROLL_RE, line)
-        if m:
-            if m.groups()[0] == "cantrip":
-                scroll_level = 0
-            else:
-                scroll_level = int(m.groups()[0][0])
-            if scroll_level < 3:
-                tts_reference_name = "Reference Scroll Low"
-            elif scroll_level < 6:
-                tts_reference_name = "Reference Scroll Medium"
-            else:
-                tts_reference_name = "Reference Scroll High"
-        m = re.match(GEM_RE, line)
-        if m:
-            gp, gem = m.groups()
-            tts_reference_name = f"{gem.strip().title()} ({int(gp):,}gp)"
-        try:
-            item = tts.reference_object(tts_reference_name or line)
-        except KeyError:
-            item = tts.reference_object("Unknown Object Token")
-        item["Nickname"] = nickname or line
-        if description:
-            item["Description"] = description
+        reference = _tts_contents_reference(line)
+        if isinstance(reference, treasure.Book):
+            return reference.tts_object()
+        item = tts.reference_object(reference)
+        item["Nickname"] = line
         return item
 
 
@@ -1,3 +1,5 @@
+import bisect
+import collections
 import functools
 import json
 import math
@@ -6,7 +8,7 @@ import random
 import re
 
 import lib.tts as tts
-from lib.utils import COC_ROOT_DIR, eval_dice
+from lib.utils import COC_ROOT_DIR, binomial, eval_dice
 
 
 @functools.cache
@@ -84,6 +86,11 @@ class Book:
         return item
 
 
+def _roll_chance(p):
+    """The chance that random.randrange(1000) < p."""
+    return min(max(math.ceil(p), 0), 1000) / 1000.0
+
+
 class TreasureLibrary:
     def __init__(self, name):
         self.name = name
@@ -92,6 +99,7 @@ class TreasureLibrary:
         self.variants = []
         self.art_objects = {}
         self.gemstones = {}
+        self.compile()
 
     def load(self):
         filename = os.path.join(
@@ -106,6 +114,47 @@ class TreasureLibrary:
                 self.art_objects[int(d["gold"])] = d["names"]
             for d in blob["gemstones"]:
                 self.gemstones[int(d["gold"])] = d["names"]
+        self.compile()
+
+    def compile(self):
+        """Prepares tables, items and variants for fast lookups. Call
+        again after changing them.
+
+        Each table becomes sorted run starts and ends for bisect, with
+        the value each run rolls, where a roll matching several ranges
+        gets the last one's value, and "00" is 0, as listed."""
+        # uppercase table name -> (run starts, run ends, values)
+        self.compiled_tables = {}
+        for t in self.tables:
+            rolls = {}
+            for d_range, value in t["table"]:
+                if "-" in d_range:
+                    lo, hi = map(int, d_range.split("-"))
+                else:
+                    lo, hi = int(d_range), int(d_range)
+                for roll in range(lo, hi + 1):
+                    rolls[roll] = value
+            starts, ends, values = [], [], []
+            for roll in sorted(rolls):
+                if ends and ends[-1] == roll - 1 and values[-1] is rolls[roll]:
+                    ends[-1] = roll
+                else:
+                    starts.append(roll)
+                    ends.append(roll)
+                    values.append(rolls[roll])
+            self.compiled_tables[t["name"].upper()] = (starts, ends, values)
+        # uppercase name -> its variants
+        self.item_variants = {}
+        for i in self.items:
+            if i.get("variants"):
+                self.item_variants[i["name"].upper()] = i["variants"]
+        self.variant_choices = {}
+        for v in self.variants:
+            self.variant_choices[v["name"].upper()] = v["variants"]
+        # item -> [(literal text, None) or (None, variant name)]
+        self.item_templates = {}
+        # (uppercase table name, die size) -> value for each roll
+        self.table_roll_values = {}
 
     def to_blob(self):
         return self
@@ -117,8 +166,9 @@ class TreasureLibrary:
         with open(filename, "w") as f:
             json.dump(self.to_blob(), f, indent=2)
 
-    def gen_horde(self, level, num_player_characters):
-        table_use = [
+    def _horde_table_use(self, level):
+        """(magic item table, chance per roll in 1000) for a hoard."""
+        return [
             ("A", 80),
             ("B", min(20 + level * 5, 50)),
             ("C", min(25 + level * 3, 70)),
@@ -129,9 +179,11 @@ class TreasureLibrary:
             ("H", min((level - 4) * 4, 25)),
             ("I", min((level - 10) * 5, 50)),
         ]
+
+    def gen_horde(self, level, num_player_characters):
         contents = []
         contents_seen = set()
-        for c, p in table_use:
+        for c, p in self._horde_table_use(level):
             tmp = []
             for _ in range(2 * num_player_characters):
                 if random.randrange(1000) < p:
@@ -141,6 +193,50 @@ class TreasureLibrary:
                         tmp.append(item)
             tmp.sort()
             contents = contents + tmp
+        return self._finish_horde(contents, level, num_player_characters)
+
+    def gen_hordes(self, parties):
+        """A hoard for each (level, num_player_characters) in parties,
+        distributed just as from gen_horde.
+
+        Rather than rolling for every player character against every
+        table, how many times each hoard hits a table is drawn at once,
+        and then all the hoards' rolls on each table together."""
+        hoard_hits = []  # [[(table name, number of hits)]]
+        table_hits = collections.Counter()  # table name -> number of hits
+        for level, num_player_characters in parties:
+            hits = []
+            for c, p in self._horde_table_use(level):
+                table_name = f"Magic Item Table {c}"
+                n = binomial(2 * num_player_characters, _roll_chance(p))
+                hits.append((table_name, n))
+                table_hits[table_name] += n
+            hoard_hits.append(hits)
+        table_rolls = {
+            table_name: iter(self.roll_on_table_many(table_name, n))
+            for table_name, n in table_hits.items()
+        }
+        hoards = []
+        for (level, num_player_characters), hits in zip(parties, hoard_hits):
+            contents = []
+            contents_seen = set()
+            for table_name, n in hits:
+                tmp = []
+                for _ in range(n):
+                    item = next(table_rolls[table_name])
+                    if item not in contents_seen:
+                        contents_seen.add(item)
+                        tmp.append(item)
+                tmp.sort()
+                contents = contents + tmp
+            hoards.append(
+                self._finish_horde(contents, level, num_player_characters)
+            )
+        return hoards
+
+    def _finish_horde(self, contents, level, num_player_characters):
+        """Adds a hoard's mundane items and valuables to its magic
+        items."""
         for _ in range(random.randrange(1, 5)):
             if random.random() < 0.25:
                 contents.append(
@@ -207,7 +303,8 @@ class TreasureLibrary:
         # loosely based on hoard numbers?
         return 2 ** (level / 2.5) * 15.0 * num_player_characters
 
-    def gen_bookshelf_horde(self, level, num_player_characters):
+    def _bookshelf_table_use(self, level):
+        """(spell scroll, chance per roll in 1000) for a bookshelf."""
         clvl = (level + 1) / 2
         freq = 50
         table_use = [
@@ -225,9 +322,12 @@ class TreasureLibrary:
         for lvl in range(10):
             p = freq * min(1.0 + (clvl - lvl) / 2.0, 1.0)
             table_use[lvl] = (table_use[lvl], p)
+        return table_use
+
+    def gen_bookshelf_horde(self, level, num_player_characters):
         contents = []
         contents_seen = set()
-        for c, p in table_use:
+        for c, p in self._bookshelf_table_use(level):
             tmp = []
             for _ in range(2 * num_player_characters):
                 if random.randrange(1000) < p:
@@ -237,6 +337,46 @@ class TreasureLibrary:
                         tmp.append(item)
             tmp.sort()
             contents = contents + tmp
+        return self._finish_bookshelf_horde(contents, contents_seen)
+
+    def gen_bookshelf_hordes(self, parties):
+        """A bookshelf's contents for each (level, num_player_characters)
+        in parties, distributed just as from gen_bookshelf_horde.
+
+        As in gen_hordes, how many scrolls of each level each bookshelf
+        holds is drawn at once, and then all the bookshelves' scrolls of
+        each level together."""
+        shelf_hits = []  # [[(item template, number of hits)]]
+        item_hits = collections.Counter()  # item template -> number of hits
+        for level, num_player_characters in parties:
+            hits = []
+            for c, p in self._bookshelf_table_use(level):
+                n = binomial(2 * num_player_characters, _roll_chance(p))
+                hits.append((c, n))
+                item_hits[c] += n
+            shelf_hits.append(hits)
+        item_rolls = {
+            c: iter(self.expand_item_many(c, n)) for c, n in item_hits.items()
+        }
+        hoards = []
+        for hits in shelf_hits:
+            contents = []
+            contents_seen = set()
+            for c, n in hits:
+                tmp = []
+                for _ in range(n):
+                    item = next(item_rolls[c])
+                    if item not in contents_seen:
+                        contents_seen.add(item)
+                        tmp.append(item)
+                tmp.sort()
+                contents = contents + tmp
+            hoards.append(
+                self._finish_bookshelf_horde(contents, contents_seen)
+            )
+        return hoards
+
+    def _finish_bookshelf_horde(self, contents, contents_seen):
         contents = [x for x in contents if x]
         max_size = eval_dice("2d4")
         contents = contents[-max_size:]
@@ -248,41 +388,73 @@ class TreasureLibrary:
                 contents_seen.add(line)
         return contents
 
+    def _table_value(self, table_name, roll):
+        starts, ends, values = self.compiled_tables[table_name.upper()]
+        ix = bisect.bisect_right(starts, roll) - 1
+        if ix >= 0 and roll <= ends[ix]:
+            return values[ix]
+        return None
+
     def roll_on_table(self, table_name, d=100):
-        table = None
-        for t in self.tables:
-            if t["name"].upper() == table_name.upper():
-                table = t
-        if table is None:
-            raise KeyError()
-        roll = random.randrange(d)
-        item = None
-        for d_range, value in table["table"]:
-            lo, hi = None, None
-            if "-" in d_range:
-                lo, hi = map(int, d_range.split("-"))
-            else:
-                lo, hi = int(d_range), int(d_range)
-            if roll >= lo and roll <= hi:
-                item = value
+        item = self._table_value(table_name, random.randrange(d))
         return self.expand_item(item or "")
 
+    def roll_on_table_many(self, table_name, k, d=100):
+        """k rolls on a table, picking them all in one go."""
+        key = (table_name.upper(), d)
+        roll_values = self.table_roll_values.get(key)
+        if roll_values is None:
+            roll_values = [
+                self._table_value(table_name, roll) or "" for roll in range(d)
+            ]
+            self.table_roll_values[key] = roll_values
+        return [self.expand_item(v) for v in random.choices(roll_values, k=k)]
+
     def expand_item(self, item):
-        for i in self.items:
-            if i["name"].upper() != item.upper():
-                continue
-            if i.get("variants"):
-                item = random.choice(i["variants"])
+        variants = self.item_variants.get(item.upper())
+        if variants:
+            item = random.choice(variants)
         return self.expand_variant(item)
 
+    def expand_item_many(self, item, k):
+        """k expansions of an item, picking each of its variables' values
+        for all of them in one go."""
+        variants = self.item_variants.get(item.upper())
+        if variants:
+            return [
+                self.expand_variant(v) for v in random.choices(variants, k=k)
+            ]
+        columns = []
+        for text, name in self._item_template(item):
+            if name is None:
+                columns.append([text] * k)
+                continue
+            variants = self.variant_choices.get(name.upper())
+            if variants is None:
+                columns.append([name] * k)
+            else:
+                columns.append(random.choices(variants, k=k))
+        return ["".join(bits) for bits in zip(*columns)]
+
+    def _item_template(self, item):
+        template = self.item_templates.get(item)
+        if template is None:
+            template = []
+            for bit in re.split("({[^}]+})", item):
+                if bit.startswith("{") and bit.endswith("}"):
+                    template.append((None, bit[1:-1].strip()))
+                else:
+                    template.append((bit, None))
+            self.item_templates[item] = template
+        return template
+
     def expand_variant(self, item):
         o = []
-        for bit in re.split("({[^}]+})", item):
-            if bit.startswith("{") and bit.endswith("}"):
-                bit = bit[1:-1].strip()
-                for v in self.variants:
-                    if v["name"].upper() != bit.upper():
-                        continue
-                    bit = random.choice(v["variants"])
-            o.append(bit)
+        for text, name in self._item_template(item):
+            if name is not None:
+                text = name
+                variants = self.variant_choices.get(name.upper())
+                if variants is not None:
+                    text = random.choice(variants)
+            o.append(text)
         return "".join(o)
@@ -1,16 +1,21 @@
-import collections
+import concurrent.futures
+import contextlib
 import copy
 import functools
+import hashlib
+import itertools
 import json
 import math
 import os
 import pathlib
+import pickle
 import random
 import re
 import sys
 
+import lib.meshes
 import lib.trap
-from lib.utils import COC_ROOT_DIR
+from lib.utils import COC_ROOT_DIR, label_grid_rectangles
 
 TTS_SPAWNED_TAG = "Spawned by Caverns of Carl"
 
@@ -75,23 +80,46 @@ def recurse_bag(obj):
         yield o
 
 
-@functools.cache
-def reference_save_json():
-    filename = os.path.join(
+def _reference_save_filename():
+    return os.path.join(
         COC_ROOT_DIR, "reference_info", "tts", "reference_save_file.json"
     )
-    with open(filename) as f:
-        blob = json.load(f)
-    refresh_tts_guids(blob)
-    return blob
+
+
+def reference_save_stamp():
+    """The reference save's [size, mtime in ns], or None if it's
+    missing, for telling whether anything derived from it is stale."""
+    try:
+        st = os.stat(_reference_save_filename())
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+# Loaded on first use; tile worker processes are handed the parent's.
+_reference_save = None
+_reference_objects = None
+
+
+def reference_save_json():
+    global _reference_save
+    if _reference_save is None:
+        filename = _reference_save_filename()
+        with open(filename) as f:
+            blob = json.load(f)
+        refresh_tts_guids(blob)
+        _reference_save = blob
+    return _reference_save
 
 
 def _normalize_nickname(nickname):
     return " ".join(nickname.strip().upper().split())
 
 
-@functools.cache
 def reference_objects():
+    global _reference_objects
+    if _reference_objects is not None:
+        return _reference_objects
     d = {}
     l = list(reference_save_json()["ObjectStates"])
     l = [x for x in l if x.get("Nickname")]
@@ -106,6 +134,7 @@ def reference_objects():
                 name = _normalize_nickname(o2.get("Nickname", ""))
                 if name and name not in d:
                     d[name] = o2
+    _reference_objects = d
     return d
 
 
@@ -118,6 +147,43 @@ def new_tts_guid():
             return guid
 
 
+# The GUIDs new_tts_guid draws from, as ints.
+_TTS_GUID_MIN = 16**5
+_TTS_GUID_MAX = 16**6
+# Random draws ranged_tts_guid makes before looking through its range.
+_TTS_GUID_RANDOM_TRIES = 32
+
+
+def ranged_tts_guid(lo, hi):
+    """Like new_tts_guid, but only returns GUIDs from lo up to hi, so
+    that processes given disjoint ranges can never hand out the same
+    GUID. Raises RuntimeError once the range is used up."""
+    global _seen_tts_guids
+    for _ in range(_TTS_GUID_RANDOM_TRIES):
+        guid = hex(random.randrange(lo, hi))[2:8]
+        if guid not in _seen_tts_guids:
+            _seen_tts_guids.add(guid)
+            return guid
+    # The range is mostly used up, so look through all of it.
+    start = random.randrange(lo, hi)
+    for n in itertools.chain(range(start, hi), range(lo, start)):
+        guid = hex(n)[2:8]
+        if guid not in _seen_tts_guids:
+            _seen_tts_guids.add(guid)
+            return guid
+    raise RuntimeError(f"All TTS GUIDs from {lo:x} up to {hi:x} are used")
+
+
+class EncodedTTSObject(str):
+    """An object already encoded as JSON, which save_tts_blob writes
+    out as is, along with its GUID."""
+
+    def __new__(cls, encoded, guid):
+        obj = super().__new__(cls, encoded)
+        obj.guid = guid
+        return obj
+
+
 def refresh_tts_guids(d):
     global _seen_tts_guids
     for k in d:
@@ -137,15 +203,172 @@ def has_reference_object(nickname):
     return nickname in reference_objects()
 
 
-def reference_object(nickname):
+def _lookup_reference_object(nickname):
     nickname = _normalize_nickname(nickname)
     if nickname not in reference_objects():
         raise KeyError(
             f"Could not find nickname '{nickname}' in tts reference game"
         )
-    o = copy.deepcopy(reference_objects()[nickname])
-    refresh_tts_guids(o)
-    return o
+    return reference_objects()[nickname]
+
+
+def reference_object(nickname):
+    """A fresh copy of a reference object.
+
+    Its GUIDs are still the reference game's; finalize_tts_object
+    assigns new ones when the object is exported."""
+    obj = copy.deepcopy(_lookup_reference_object(nickname))
+    obj[_REFERENCE_KEY] = _normalize_nickname(nickname)
+    return obj
+
+
+@functools.cache
+def reference_mesh_url(nickname, key="MeshURL"):
+    """One of a reference object's CustomMesh URLs, without copying it."""
+    return _lookup_reference_object(nickname)["CustomMesh"][key]
+
+
+_LIGHT_MUL_KEY = "_coc_light_mul"
+_REFERENCE_KEY = "_coc_reference"
+
+
+def set_light_mul(obj, mul):
+    """Darkens obj's floor meshes by mul once it's finalized."""
+    obj[_LIGHT_MUL_KEY] = mul
+
+
+def light_mul(obj):
+    return obj.get(_LIGHT_MUL_KEY, 1.0)
+
+
+# What TTS assumes for fields left out of a saved object.
+_TTS_OBJECT_DEFAULTS = {
+    "Nickname": "",
+    "Description": "",
+    "GMNotes": "",
+    "Locked": False,
+    "Grid": True,
+    "Snap": True,
+    "IgnoreFoW": False,
+    "MeasureMovement": False,
+    "DragSelectable": True,
+    "Autoraise": True,
+    "Sticky": True,
+    "Tooltip": True,
+    "GridProjection": False,
+    "Value": 0,
+    "LayoutGroupSortIndex": 0,
+    "AltLookAngle": {"x": 0.0, "y": 0.0, "z": 0.0},
+    "LuaScript": "",
+    "LuaScriptState": "",
+    "XmlUI": "",
+}
+
+
+def compact_tts_object(obj, transform_digits):
+    """Drops obj's fields that match TTS defaults and rounds its
+    Transform. Nested objects are left alone."""
+    for k, v in _TTS_OBJECT_DEFAULTS.items():
+        if k in obj and obj[k] == v:
+            del obj[k]
+    transform = obj.get("Transform", {})
+    for k, v in transform.items():
+        transform[k] = round(v, transform_digits)
+
+
+def _tagged_gmnotes(gmnotes, name_tag):
+    if gmnotes:
+        return f"{gmnotes}\n\n{name_tag}"
+    return name_tag
+
+
+def finalize_tts_object(
+    obj, name_tag, new_guid=new_tts_guid, transform_digits=None
+):
+    """Readies an object tree for the save file in a single walk.
+
+    Scripts are cleared, GMNotes are tagged with name_tag for later
+    mass deletion, fresh GUIDs are assigned, and any light level from
+    set_light_mul is applied to floor meshes. With transform_digits,
+    every object is also compacted with compact_tts_object. Returns the
+    nickname of the reference object obj was copied from, if any."""
+    floor_mesh = reference_mesh_url("Floor, Dungeon")
+    reference = obj.get(_REFERENCE_KEY)
+    stack = [(obj, obj.pop(_LIGHT_MUL_KEY, 1.0))]
+    while stack:
+        o, mul = stack.pop()
+        o.pop(_REFERENCE_KEY, None)
+        o["LuaScript"] = ""
+        o["LuaScriptState"] = ""
+        o["XmlUI"] = ""
+        o["GMNotes"] = _tagged_gmnotes(o.get("GMNotes", ""), name_tag)
+        if "GUID" in o:
+            o["GUID"] = new_guid()
+        if mul != 1.0:
+            if o.get("CustomMesh", {}).get("MeshURL") == floor_mesh:
+                color = o.setdefault("ColorDiffuse", {})
+                for k in "rgb":
+                    color[k] = color.get(k, 1.0) * mul
+        if transform_digits is not None:
+            compact_tts_object(o, transform_digits)
+        for other in o.get("States", {}).values():
+            stack.append((other, mul))
+        for other in o.get("ChildObjects", []):
+            stack.append((other, mul))
+        for other in o.get("ContainedObjects", []):
+            stack.append((other, 1.0))
+    return reference
+
+
+class TTSObjectTemplate:
+    """An object finalized once and encoded as JSON with holes for its
+    GUIDs, its GMNotes and the Transform fields in transform_keys.
+
+    Copies differing only in those are then encoded with a single
+    str.format, rather than each being built as a dict, finalized and
+    passed through json.dumps."""
+
+    _HOLE_RE = re.compile(r'"@@coc-hole:(\w+)@@"')
+
+    def __init__(self, obj, name_tag, transform_keys, transform_digits=None):
+        self.name_tag = name_tag
+        self.transform_keys = tuple(transform_keys)
+        self.transform_digits = transform_digits
+        self.num_guids = 0
+        self.has_guid = "GUID" in obj
+
+        def new_guid():
+            self.num_guids += 1
+            return f"@@coc-hole:guid{self.num_guids - 1}@@"
+
+        self.reference = finalize_tts_object(
+            obj,
+            name_tag,
+            new_guid=new_guid,
+            transform_digits=transform_digits,
+        )
+        obj["GMNotes"] = "@@coc-hole:gmnotes@@"
+        for k in self.transform_keys:
+            obj["Transform"][k] = f"@@coc-hole:{k}@@"
+        encoded = json.dumps(obj, separators=(",", ":"))
+        encoded = encoded.replace("{", "{{").replace("}", "}}")
+        self.format_string = self._HOLE_RE.sub(r"{\1}", encoded)
+
+    def encode(self, gmnotes="", new_guid=new_tts_guid, **transform):
+        """An EncodedTTSObject with fresh GUIDs and the given fields."""
+        fields = {f"guid{i}": f'"{new_guid()}"' for i in range(self.num_guids)}
+        fields["gmnotes"] = json.encoder.encode_basestring_ascii(
+            _tagged_gmnotes(gmnotes, self.name_tag)
+        )
+        for k in self.transform_keys:
+            v = float(transform[k])
+            if self.transform_digits is not None:
+                v = round(v, self.transform_digits)
+            fields[k] = repr(v)
+        guid = None
+        if self.has_guid:
+            guid = fields["guid0"][1:-1]
+        return EncodedTTSObject(self.format_string.format(**fields), guid)
 
 
 def tts_fog(posX=0.0, posZ=0.0, scaleX=1.0, scaleZ=1.0, hidden_zone=False):
@@ -232,20 +455,18 @@ class TTSFogBit:
         self.corridorixs = self.corridorixs.union(other.corridorixs)
         self.riverixs = self.riverixs.union(other.riverixs)
 
-    def tts_fog(self, df):
+    def tts_fog_transform(self, df):
         x = (self.x1 + self.x2) / 2.0
         y = (self.y1 + self.y2) / 2.0
-        posX = x - math.floor(df.width / 2.0) + 0.5
-        posZ = y - math.floor(df.height / 2.0) + 0.5
-        scaleX = 2 * (x - self.x1 + 0.5)
-        scaleZ = 2 * (y - self.y1 + 0.5)
-        return tts_fog(
-            hidden_zone=True,
-            posX=posX,
-            posZ=posZ,
-            scaleX=scaleX,
-            scaleZ=scaleZ,
-        )
+        return {
+            "posX": x - math.floor(df.width / 2.0) + 0.5,
+            "posZ": y - math.floor(df.height / 2.0) + 0.5,
+            "scaleX": 2 * (x - self.x1 + 0.5),
+            "scaleZ": 2 * (y - self.y1 + 0.5),
+        }
+
+    def tts_fog(self, df):
+        return tts_fog(hidden_zone=True, **self.tts_fog_transform(df))
 
     def room_corridor_signature(self):
         return (
@@ -256,74 +477,195 @@ class TTSFogBit:
 
     @staticmethod
     def merge_fog_bits(fog_bits):
-        # Better merging maybe: https://mathoverflow.net/a/80676
-
-        # room/corridor signature : list[bit]
-        groups = collections.defaultdict(list)
+        # Label every cell of a grid with an integer for its
+        # room/corridor/river signature, then cover each label's cells
+        # with as few rectangles as we reasonably can.
+        fog_bits = list(fog_bits)
+        if not fog_bits:
+            return []
+        x0 = min(bit.x1 for bit in fog_bits)
+        y0 = min(bit.y1 for bit in fog_bits)
+        width = max(bit.x2 for bit in fog_bits) - x0 + 1
+        height = max(bit.y2 for bit in fog_bits) - y0 + 1
+        labels = [None] * (width * height)
+        priorities = [0] * (width * height)
+        signatures = [((), (), ())]
+        signature_labels = {signatures[0]: 0}  # signature : label
         for bit in fog_bits:
-            groups[bit.room_corridor_signature()].append(bit)
+            label = 0
+            if bit.roomixs or bit.corridorixs or bit.riverixs:
+                signature = bit.room_corridor_signature()
+                label = signature_labels.get(signature)
+                if label is None:
+                    label = len(signatures)
+                    signature_labels[signature] = label
+                    signatures.append(signature)
+            for y in range(bit.y1 - y0, bit.y2 - y0 + 1):
+                for c in range(
+                    y * width + bit.x1 - x0, y * width + bit.x2 - x0 + 1
+                ):
+                    labels[c] = label
+                    priorities[c] = bit.priority
         output = []
-        for l in groups.values():
-            singletons = {(bit.x1, bit.y1): bit for bit in l}
-            while len(singletons) > 0:
-                # get the highest priority thing which isn't maximally expanded
-                bit = None
-                for x in singletons.values():
-                    if bit is None or x.priority > bit.priority:
-                        bit = x
-                del singletons[(bit.x1, bit.y1)]
-                for _ in range(500):
-                    annex_coords = []
-                    x1, x2, y1, y2 = bit.x1, bit.x2, bit.y1, bit.y2
-                    dirs = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-                    random.shuffle(dirs)
-                    for dx, dy in dirs:
-                        m = []
-                        if dx < 0:
-                            m = [(x1 + dx, y) for y in range(y1, y2 + 1)]
-                        elif dx > 0:
-                            m = [(x2 + dx, y) for y in range(y1, y2 + 1)]
-                        elif dy < 0:
-                            m = [(x, y1 + dy) for x in range(x1, x2 + 1)]
-                        elif dy > 0:
-                            m = [(x, y2 + dy) for x in range(x1, x2 + 1)]
-                        if len(m) > sum([c in singletons for c in m]):
-                            continue
-                        if len(m) > len(annex_coords):
-                            annex_coords = m
-                    if len(annex_coords) < 1:
-                        break
-                    for x, y in annex_coords:
-                        del singletons[(x, y)]
-                        bit.x1 = min(bit.x1, x)
-                        bit.x2 = max(bit.x2, x)
-                        bit.y1 = min(bit.y1, y)
-                        bit.y2 = max(bit.y2, y)
-                output.append(bit)
+        for label, x1, y1, x2, y2 in label_grid_rectangles(
+            labels, width, priorities
+        ):
+            roomixs, corridorixs, riverixs = signatures[label]
+            priority = max(
+                priorities[y * width + x]
+                for x in range(x1, x2 + 1)
+                for y in range(y1, y2 + 1)
+            )
+            output.append(
+                TTSFogBit(
+                    x1 + x0,
+                    y1 + y0,
+                    x2 + x0,
+                    y2 + y0,
+                    roomixs=roomixs,
+                    corridorixs=corridorixs,
+                    riverixs=riverixs,
+                    priority=priority,
+                )
+            )
         return output
 
 
 _LUA_SCRIPT = """
 GM_NOTES_MATCHER = "REPLACE ME"
+SPAWN_BATCH_SIZE = 40
+PLAYER_COLORS = {"White", "Brown", "Red", "Orange", "Yellow", "Green", "Teal", "Blue", "Purple", "Pink", "Grey"}
+-- GUIDs of what was exported, grouped; see TTSEmitter.registry
+registry = {notecards = {}, rooms = {}, corridors = {}, spawned = {}}
+spawn_queue = nil
 
 
-function onLoad()
-    update_visibility()
+function onLoad(script_state)
+    local state = {}
+    if script_state ~= nil and script_state ~= "" then
+        state = JSON.decode(script_state)
+    end
+    registry = state.registry or registry
+    self.createButton({
+        click_function = "delete_everything",
+        function_owner = self,
+        label = "Delete everything spawned",
+        position = {0, 0.5, 0},
+        width = 1800,
+        height = 300,
+        font_size = 120,
+    })
+    setup_notecards()
+    if state.spawn ~= nil then
+        spawn_queue = state.spawn
+        startLuaCoroutine(self, "spawn_batches")
+    end
 end
 function onPlayerChangeColor(color)
     update_visibility()
 end
+function onSave()
+    return JSON.encode({registry = registry, spawn = spawn_queue})
+end
+
+
+function set_registry(params)
+    registry = params.registry
+    setup_notecards()
+end
 
 
 function update_visibility()
-    local colors = {"White", "Brown", "Red", "Orange", "Yellow", "Green", "Teal", "Blue", "Purple", "Pink", "Grey"}
-    for ix, obj in ipairs(getObjects()) do
-        if obj.getGMNotes():find(GM_NOTES_MATCHER) then
-            if obj.type == "Notecard" then
-                obj.setInvisibleTo(colors)
+    for _, guid in ipairs(registry.notecards) do
+        local obj = getObjectFromGUID(guid)
+        if obj ~= nil then
+            obj.setInvisibleTo(PLAYER_COLORS)
+        end
+    end
+end
+
+
+function setup_notecards()
+    update_visibility()
+    for kind, groups in pairs({Room = registry.rooms, Corridor = registry.corridors}) do
+        for _, group in pairs(groups) do
+            for _, guid in ipairs(group.notecards or {}) do
+                local obj = getObjectFromGUID(guid)
+                if obj ~= nil then
+                    obj.clearContextMenu()
+                    obj.addContextMenuItem("Reveal " .. kind, function(player_color)
+                        reveal(group)
+                    end)
+                end
+            end
+        end
+    end
+end
+
+
+function reveal(group)
+    for _, guid in ipairs(group.zones or {}) do
+        local obj = getObjectFromGUID(guid)
+        if obj ~= nil then
+            obj.destruct()
+        end
+    end
+end
+
+
+function delete_everything(obj, player_color)
+    if not Player[player_color].admin then return end
+    spawn_queue = nil
+    for _, guid in ipairs(registry.spawned) do
+        local spawned = getObjectFromGUID(guid)
+        if spawned ~= nil then
+            spawned.destruct()
+        end
+    end
+    self.destruct()
+end
+
+
+function hide_from_players(obj)
+    obj.setInvisibleTo(PLAYER_COLORS)
+end
+
+
+function spawn_batches()
+    local objects = spawn_queue.objects
+    -- Notecards are hidden the moment they spawn, not once all is done.
+    local notecards = {}
+    for _, guid in ipairs(registry.notecards) do
+        notecards[guid] = true
+    end
+    while spawn_queue ~= nil and spawn_queue.next_ix <= #objects do
+        local entry = objects[spawn_queue.next_ix]
+        local data = {}
+        local template = spawn_queue.templates[entry[1]]
+        if template ~= nil then
+            for k, v in pairs(template) do
+                data[k] = v
             end
         end
+        for k, v in pairs(entry[2]) do
+            data[k] = v
+        end
+        for _, k in ipairs(entry[3]) do
+            data[k] = nil
+        end
+        if notecards[data.GUID] then
+            spawnObjectData({data = data, callback_function = hide_from_players})
+        else
+            spawnObjectData({data = data})
+        end
+        spawn_queue.next_ix = spawn_queue.next_ix + 1
+        if spawn_queue.next_ix % SPAWN_BATCH_SIZE == 0 then
+            coroutine.yield(0)
+        end
     end
+    spawn_queue = nil
+    setup_notecards()
+    return 1
 end
 
 
@@ -361,38 +703,532 @@ end
 """.strip()
 
 
-def dungeon_to_tts_blob(df, name, pdf_filename=None):
-    blob = copy.deepcopy(reference_save_json())
-    blob["SaveName"] = name
-    blob["GameMode"] = name
-    blob["ObjectStates"] = []
-    for tile in df.tile_iter():
-        for obj in tile.tts_objects(df):
-            df.tts_xz(tile.x, tile.y, obj)
-            blob["ObjectStates"].append(obj)
-    for light_source in df.light_sources:
-        blob["ObjectStates"].append(light_source.tts_object(df))
-    for monster in df.monsters:
-        obj = monster.tts_object(df)
-        blob["ObjectStates"].append(obj)
+_LUA_PATCH_SCRIPT = """
+DELETED_GUIDS = {REPLACE GUIDS}
+CARRIER_GUID = "REPLACE CARRIER"
+REGISTRY = [==[REPLACE REGISTRY]==]
+
+
+function onLoad()
+    self.setInvisibleTo({"White", "Brown", "Red", "Orange", "Yellow", "Green", "Teal", "Blue", "Purple", "Pink", "Grey"})
+    for _, guid in ipairs(DELETED_GUIDS) do
+        local obj = getObjectFromGUID(guid)
+        if obj ~= nil then
+            obj.destruct()
+        end
+    end
+    local carrier = getObjectFromGUID(CARRIER_GUID)
+    if carrier ~= nil then
+        carrier.call("set_registry", {registry = JSON.decode(REGISTRY)})
+    end
+    self.destruct()
+end
+""".strip()
+
+
+def culled_wall_coords(df):
+    """Returns the set of (x, y) of walls nobody could ever see.
+
+    These are walls with no walkable, water or door tile (or anything
+    else that isn't a plain wall) in their 8-neighbourhood; out of
+    bounds counts as wall."""
+    all_walls = 0xFF  # see DungeonFloor.wall_masks
+    masks = df.wall_masks()
+    culled = set()
+    for x in range(df.width):
+        for y in range(df.height):
+            if masks[x][y] == all_walls and df.tiles[x][y].is_wall():
+                culled.add((x, y))
+    return culled
+
+
+def wall_backdrops(df, culled_coords):
+    """Returns a few scaled dark slabs covering the culled walls."""
+    labels = [None] * (df.width * df.height)
+    for x, y in culled_coords:
+        labels[x + y * df.width] = 0
+    output = []
+    for _, x1, y1, x2, y2 in label_grid_rectangles(labels, df.width):
+        obj = reference_object("Reference Cube")
+        obj["Nickname"] = ""
+        obj["Description"] = ""
+        obj["Transform"]["scaleX"] = x2 - x1 + 1.0
+        obj["Transform"]["scaleY"] = 2.0
+        obj["Transform"]["scaleZ"] = y2 - y1 + 1.0
+        obj["Transform"]["posY"] = 2.7
+        obj["ColorDiffuse"] = {"r": 0.1, "g": 0.1, "b": 0.1}
+        obj["Locked"] = True
+        df.tts_xz((x1 + x2) / 2.0, (y1 + y2) / 2.0, obj)
+        output.append(obj)
+    return output
+
+
+def floor_slabs(df, skip_coords=frozenset()):
+    """Merges contiguous, identical floor tiles into scaled slabs.
+
+    Tiles are identical when they agree on their floor_slab_key, which
+    covers room or corridor, style, light level and traps. Tiles under
+    special features, and those in skip_coords, are left alone. Returns
+    the slab objects and the set of (x, y) they cover."""
+    feature_coords = set()
+    for feature in df.special_features:
+        for x, y, _ in feature.ascii_chars(df):
+            feature_coords.add((x, y))
+    keys = []
+    key_labels = {}  # floor slab key : label
+    labels = [None] * (df.width * df.height)
+    for x in range(df.width):
+        for y in range(df.height):
+            key = df.tiles[x][y].floor_slab_key()
+            if key is None or (x, y) in feature_coords:
+                continue
+            if (x, y) in skip_coords:
+                continue
+            label = key_labels.get(key)
+            if label is None:
+                label = len(keys)
+                key_labels[key] = label
+                keys.append(key)
+            labels[x + y * df.width] = label
+    slabs = []
+    merged_coords = set()
+    for _, x1, y1, x2, y2 in label_grid_rectangles(labels, df.width):
+        obj = df.tiles[x1][y1]._floor_tile_tts_object(df)
+        if x1 != x2 or y1 != y2:
+            # Quarter turns would swap the slab's axes.
+            obj["Transform"]["rotY"] = 180.0 * random.randrange(2)
+            obj["Transform"]["scaleX"] *= x2 - x1 + 1
+            obj["Transform"]["scaleZ"] *= y2 - y1 + 1
+        df.tts_xz((x1 + x2) / 2.0, (y1 + y2) / 2.0, obj)
+        slabs.append(obj)
+        for x in range(x1, x2 + 1):
+            for y in range(y1, y2 + 1):
+                merged_coords.add((x, y))
+    return (slabs, merged_coords)
+
+
+def fog_blocker_segments(df):
+    """Returns (x1, y1, x2, y2) for each line of sight blocker.
+
+    A blocker sits between two adjacent tiles which both block line of
+    sight, at least one of which is a wall. Runs of collinear blockers
+    are merged into one maximal segment, so each straight stretch of
+    wall needs only one cube."""
+    horizontal = []  # (y, x) of blockers between (x, y) and (x + 1, y)
+    vertical = []  # (x, y) of blockers between (x, y) and (x, y + 1)
+    for x in range(df.width - 1):
+        for y in range(df.height - 1):
+            t = df.tiles[x][y]
+            if not t.blocks_line_of_sight():
+                continue
+            r = df.tiles[x + 1][y]
+            if r.blocks_line_of_sight() and (t.is_wall() or r.is_wall()):
+                horizontal.append((y, x))
+            u = df.tiles[x][y + 1]
+            if u.blocks_line_of_sight() and (t.is_wall() or u.is_wall()):
+                vertical.append((x, y))
+    segments = []
+    for runs, is_horizontal in [(horizontal, True), (vertical, False)]:
+        runs.sort()
+        ix = 0
+        while ix < len(runs):
+            line, start = runs[ix]
+            end = start
+            while ix + 1 < len(runs) and runs[ix + 1] == (line, end + 1):
+                ix += 1
+                end += 1
+            if is_horizontal:
+                segments.append((start + 0.5, line, end + 0.5, line))
+            else:
+                segments.append((line, start + 0.5, line, end + 0.5))
+            ix += 1
+    return segments
+
+
+class TTSEmitter:
+    """Collects the objects of one export, finalizing each once.
+
+    Every object is emitted under a source key, e.g. ("tile", x, y) or
+    ("room", roomix). With an export_id the export is incremental:
+    each source's objects are generated under their own seeded random
+    state (see source) and get GUIDs hashed from the export_id, the
+    source key and the objects' contents, so a source that hasn't
+    changed gets identical objects with identical GUIDs every time."""
+
+    def __init__(self, name_tag, export_id=None, transform_digits=None):
+        self.name_tag = name_tag
+        self.export_id = export_id
+        self.transform_digits = transform_digits
+        self.offset_x = 0.0
+        self.references = {}  # GUID -> reference object nickname
+        self.group_prefix = ""
+        self.script_carrier = None
+        self.registrations = []  # [(object, path)]
+        self.new_guid = new_tts_guid
+        # Set for exports whose objects are only ever written out; see
+        # emit_templated and emit_tiles_in_parallel.
+        self.use_templates = False
+        self.templates = {}  # (template key, name tag) -> TTSObjectTemplate
+        self.tile_workers = 1
+        self.objects = []
+        self.pending = {}  # source key -> [object]
+
+    def source(self, key):
+        """Context to generate a source's objects in."""
+        if self.export_id is None:
+            return contextlib.nullcontext()
+        return keyed_random((self.export_id, key))
+
+    def emit(self, key, *objs):
+        if self.offset_x:
+            for obj in objs:
+                obj["Transform"]["posX"] += self.offset_x
+        if self.export_id is None:
+            for obj in objs:
+                reference = finalize_tts_object(
+                    obj,
+                    self.name_tag,
+                    new_guid=self.new_guid,
+                    transform_digits=self.transform_digits,
+                )
+                self.references[obj.get("GUID")] = reference
+                self.objects.append(obj)
+        else:
+            self.pending.setdefault(key, []).extend(objs)
+
+    def emit_encoded(self, *encoded_objs):
+        """Emits EncodedTTSObjects, which are already finalized."""
+        assert self.export_id is None
+        self.objects += encoded_objs
+
+    def emit_templated(self, template_key, build, gmnotes="", **transform):
+        """Emits a copy of the object build returns, with the given
+        GMNotes and Transform fields, through a TTSObjectTemplate.
+
+        build is only called the first time template_key is seen, so
+        the key must cover everything else the object depends on.
+        Returns the EncodedTTSObject."""
+        assert self.use_templates and self.export_id is None
+        if "posX" in transform:
+            transform["posX"] += self.offset_x
+        template = self.templates.get((template_key, self.name_tag))
+        if template is None:
+            template = TTSObjectTemplate(
+                build(), self.name_tag, transform, self.transform_digits
+            )
+            self.templates[(template_key, self.name_tag)] = template
+        encoded = template.encode(gmnotes, new_guid=self.new_guid, **transform)
+        self.references[encoded.guid] = template.reference
+        self.objects.append(encoded)
+        return encoded
+
+    def register(self, obj, *paths):
+        """Lists obj's GUID in the registry under each path.
+
+        A path is a tuple of keys, e.g. ("rooms", "3", "zones")."""
+        for path in paths:
+            self.registrations.append((obj, path))
+
+    def registry(self):
+        """The registry the script carrier's script works from.
+
+        Call after finish, once GUIDs are assigned. Besides what was
+        registered, it lists every top-level object but the script
+        carrier under "spawned"."""
+        registry = {"notecards": [], "rooms": {}, "corridors": {}}
+        for obj, path in self.registrations:
+            d = registry
+            for k in path[:-1]:
+                d = d.setdefault(k, {})
+            d.setdefault(path[-1], []).append(_object_guid(obj))
+        if self.export_id is None:
+            objs = self.objects
+        else:
+            objs = [
+                obj
+                for key, l in self.pending.items()
+                if key != ("script carrier",)
+                for obj in l
+            ]
+        registry["spawned"] = [
+            _object_guid(obj) for obj in objs if obj is not self.script_carrier
+        ]
+        return registry
+
+    def finish(self, old_manifest=None):
+        """Returns (objects, manifest, deleted GUIDs).
+
+        The manifest maps each source key to its objects' GUIDs. Given
+        the manifest of a previous incremental export of the same floor,
+        only objects of changed sources are returned, along with the
+        GUIDs of the objects they replace."""
+        if self.export_id is None:
+            return (self.objects, None, [])
+        taken = set()
+        manifest = {}
+        objects = []
+        for key, objs in self.pending.items():
+            digest = hashlib.sha1(
+                json.dumps(objs, sort_keys=True).encode()
+            ).hexdigest()
+            counter = itertools.count()
+
+            def new_guid():
+                while True:
+                    parts = (self.export_id, key, digest, next(counter))
+                    guid = hashlib.sha1(repr(parts).encode()).hexdigest()[:6]
+                    if guid not in taken:
+                        taken.add(guid)
+                        _seen_tts_guids.add(guid)
+                        return guid
+
+            for obj in objs:
+                reference = finalize_tts_object(
+                    obj,
+                    self.name_tag,
+                    new_guid=new_guid,
+                    transform_digits=self.transform_digits,
+                )
+                self.references[obj.get("GUID")] = reference
+            manifest[key] = [obj["GUID"] for obj in objs]
+            if old_manifest is None or old_manifest.get(key) != manifest[key]:
+                objects += objs
+        deleted = []
+        for key, guids in (old_manifest or {}).items():
+            if manifest.get(key) != guids:
+                deleted += [guid for guid in guids if guid not in taken]
+        return (objects, manifest, deleted)
+
+
+def _object_guid(obj):
+    if isinstance(obj, EncodedTTSObject):
+        return obj.guid
+    return obj["GUID"]
+
+
+@contextlib.contextmanager
+def keyed_random(key):
+    """Context seeding random from key, restoring its state after."""
+    state = random.getstate()
+    random.seed(repr(key))
+    try:
+        yield
+    finally:
+        random.setstate(state)
+
+
+_worker_df = None
+
+
+def _init_tile_worker(pickled_df, references, seen_guids):
+    """Readies a tile worker process before any band is seeded.
+
+    It's handed the parent's reference save and objects, and the GUIDs
+    seen so far, rather than loading its own: loading draws random
+    numbers, and under the spawn start method would otherwise happen
+    inside whichever band came first, after its seed."""
+    global _worker_df, _reference_save, _reference_objects, _seen_tts_guids
+    _reference_save, _reference_objects = references
+    _seen_tts_guids = set(seen_guids)
+    _worker_df = pickle.loads(pickled_df)
+
+
+def _encode_tile_band(args):
+    return _build_tile_band(_worker_df, args)
+
+
+def _build_tile_band(df, args):
+    """Builds, finalizes and encodes the tiles of rows y1 down to y2."""
+    (
+        y1,
+        y2,
+        skip_coords,
+        name_tag,
+        transform_digits,
+        offset_x,
+        guid_range,
+        seed,
+    ) = args
+    random.seed(seed)
+    emitter = TTSEmitter(name_tag, transform_digits=transform_digits)
+    emitter.offset_x = offset_x
+    emitter.new_guid = functools.partial(ranged_tts_guid, *guid_range)
+    emitter.use_templates = True
+    for y in range(y1, y2 - 1, -1):
+        for x in range(df.width):
+            if (x, y) not in skip_coords:
+                emit_tile_objects(df, df.tiles[x][y], emitter)
+    output = []
+    for obj in emitter.objects:
+        if isinstance(obj, EncodedTTSObject):
+            output.append((str(obj), obj.guid))
+        else:
+            output.append(
+                (json.dumps(obj, separators=(",", ":")), obj["GUID"])
+            )
+    return output
+
+
+def _tile_band_tasks(df, emitter, skip_coords):
+    """Splits the floor into bands of rows, a few per tile worker, each
+    with its own random seed and an equal share of the GUID space.
+
+    Workers are handed every GUID seen so far, and this process draws
+    none while they run, so the bands' ranges need only be disjoint."""
+    num_bands = min(df.height, 4 * emitter.tile_workers)
+    band_height = math.ceil(df.height / num_bands)
+    y1s = range(df.height - 1, -1, -band_height)
+    guid_range_size = (_TTS_GUID_MAX - _TTS_GUID_MIN) // len(y1s)
+    tasks = []
+    for ix, y1 in enumerate(y1s):
+        y2 = max(0, y1 - band_height + 1)
+        guid_lo = _TTS_GUID_MIN + ix * guid_range_size
+        band_skips = {(x, y) for x, y in skip_coords if y2 <= y <= y1}
+        tasks.append(
+            (
+                y1,
+                y2,
+                band_skips,
+                emitter.name_tag,
+                emitter.transform_digits,
+                emitter.offset_x,
+                (guid_lo, guid_lo + guid_range_size),
+                random.getrandbits(64),
+            )
+        )
+    return tasks
+
+
+def _encode_tile_bands(df, tasks, workers=None, mp_context=None):
+    """The encoded (object, GUID)s of each band task, built in workers
+    processes, or in this one if workers is None."""
+    if workers is None:
+        return [_build_tile_band(df, task) for task in tasks]
+    references = (reference_save_json(), reference_objects())
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp_context,
+        initializer=_init_tile_worker,
+        initargs=(pickle.dumps(df), references, _seen_tts_guids),
+    ) as pool:
+        return list(pool.map(_encode_tile_band, tasks))
+
+
+def emit_tiles_in_parallel(df, emitter, skip_coords):
+    """Emits the floor's tiles, built in emitter.tile_workers processes.
+
+    Each band of rows is built and encoded from a pickled copy of the
+    floor under its own random seed and GUID range, and the encoded
+    objects are emitted in the same order as tile_iter would give."""
+    tasks = _tile_band_tasks(df, emitter, skip_coords)
+    for band in _encode_tile_bands(df, tasks, emitter.tile_workers):
+        for encoded, guid in band:
+            _seen_tts_guids.add(guid)
+            emitter.emit_encoded(EncodedTTSObject(encoded, guid))
+
+
+def _use_fast_paths(emitter, config):
+    """Lets an export whose objects are only ever written out skip
+    building them all as dicts, and spread tiles over processes."""
+    if config.tts_lua_spawner:
+        return
+    emitter.use_templates = True
+    if config.tts_export_workers > 1:
+        emitter.tile_workers = config.tts_export_workers
+
+
+def emit_tile_objects(df, tile, emitter):
+    key = ("tile", tile.x, tile.y)
+    templated = None
+    with emitter.source(key):
+        if emitter.use_templates:
+            templated = tile.tts_templated_objects(df)
+        if templated is None:
+            objs = tile.tts_objects(df)
+    if templated is not None:
+        for template_key, build, gmnotes, transform in templated:
+            emitter.emit_templated(template_key, build, gmnotes, **transform)
+        return
+    for obj in objs:
+        df.tts_xz(tile.x, tile.y, obj)
+    emitter.emit(key, *objs)
+
+
+def emit_dungeon_objects(df, name, emitter, pdf_filename=None):
+    """Emits all of a floor's objects, besides its script carrier."""
+    culled_coords = set()
+    if df.config.tts_interior_walls != "keep":
+        culled_coords = culled_wall_coords(df)
+    if df.config.tts_combined_meshes:
+        with emitter.source(("meshes",)):
+            meshes, baked_coords = lib.meshes.combined_mesh_objects(
+                df, name, skip_coords=culled_coords
+            )
+        emitter.emit(("meshes",), *meshes)
+        culled_coords.update(baked_coords)
+    if df.config.tts_merge_floor_tiles:
+        with emitter.source(("floor slabs",)):
+            slabs, merged_coords = floor_slabs(df, skip_coords=culled_coords)
+        emitter.emit(("floor slabs",), *slabs)
+        culled_coords.update(merged_coords)
+    if emitter.tile_workers > 1:
+        emit_tiles_in_parallel(df, emitter, culled_coords)
+    else:
+        for tile in df.tile_iter():
+            if (tile.x, tile.y) not in culled_coords:
+                emit_tile_objects(df, tile, emitter)
+    if df.config.tts_interior_walls == "backdrop":
+        emitter.emit(("backdrops",), *wall_backdrops(df, culled_coords))
+    for ix, light_source in enumerate(df.light_sources):
+        key = ("light", ix)
+        with emitter.source(key):
+            emitter.emit(key, light_source.tts_object(df))
+    for ix, monster in enumerate(df.monsters):
+        key = ("monster", ix)
+        if monster.roomix is not None:
+            key = ("room", monster.roomix)
+        with emitter.source(("monster", monster.x, monster.y)):
+            obj = monster.tts_object(df)
+        emitter.emit(key, obj)
     for ix, npc in enumerate(df.npcs):
         x, y = npc.x, npc.y
         if True or x is None or y is None:
             y = -3
             x = int(df.width / 2) + ix
-        obj = npc.tts_object(df, x, y)
-        blob["ObjectStates"].append(obj)
+        with emitter.source(("npc", ix)):
+            obj = npc.tts_object(df, x, y)
+        emitter.emit(("npc", ix), obj)
     handouts = []
     for room in df.rooms:
-        for feature in room.special_features(df):
-            blob["ObjectStates"] += feature.tts_objects(df)
-            handouts += feature.tts_handouts()
-        if df.config.tts_notecards and not room.is_trivial():
-            blob["ObjectStates"].append(room.tts_notecard(df))
+        key = ("room", room.ix)
+        with emitter.source(key):
+            for feature in room.special_features(df):
+                emitter.emit(key, *feature.tts_objects(df))
+                handouts += feature.tts_handouts()
+            if df.config.tts_notecards and not room.is_trivial():
+                obj = room.tts_notecard(df)
+                emitter.register(
+                    obj,
+                    ("notecards",),
+                    ("rooms", f"{emitter.group_prefix}{room.ix}", "notecards"),
+                )
+                emitter.emit(key, obj)
     for corridor in df.corridors:
+        key = ("corridor", corridor.ix)
         if df.config.tts_notecards and corridor.is_nontrivial(df):
-            blob["ObjectStates"].append(corridor.tts_notecard(df))
-    for trap in df.traps:
+            with emitter.source(key):
+                obj = corridor.tts_notecard(df)
+            emitter.register(
+                obj,
+                ("notecards",),
+                (
+                    "corridors",
+                    f"{emitter.group_prefix}{corridor.ix}",
+                    "notecards",
+                ),
+            )
+            emitter.emit(key, obj)
+    for ix, trap in enumerate(df.traps):
         if not df.config.tts_notecards:
             break
         if isinstance(trap, lib.trap.RoomTrap) or isinstance(
@@ -406,40 +1242,32 @@ def dungeon_to_tts_blob(df, name, pdf_filename=None):
         obj["Transform"]["posY"] = 4.0
         obj["Locked"] = True
         df.tts_xz(trap.x, trap.y, obj)
-        blob["ObjectStates"].append(obj)
+        emitter.register(obj, ("notecards",))
+        emitter.emit(("trap", ix), obj)
     for ix, handout in enumerate(handouts):
         y = -5
         x = int(df.width / 2) + ix
         df.tts_xz(x, y, handout)
-        blob["ObjectStates"].append(handout)
+        emitter.emit(("handout", ix), handout)
 
-    def create_fog_blocker(x, y):
+    def create_fog_blocker(x1, y1, x2, y2):
         obj = reference_object("Reference Cube")
         obj["Nickname"] = ""
         obj["Description"] = ""
-        obj["Transform"]["scaleX"] = 0.2
+        obj["Transform"]["scaleX"] = x2 - x1 + 0.2
         obj["Transform"]["scaleY"] = 2.0
-        obj["Transform"]["scaleZ"] = 0.2
+        obj["Transform"]["scaleZ"] = y2 - y1 + 0.2
         obj["Transform"]["posY"] = 2.7
         obj["ColorDiffuse"] = {"r": 0.2, "g": 0.2, "b": 0.2}
         obj["Locked"] = True
-        df.tts_xz(x, y, obj)
-        blob["ObjectStates"].append(obj)
+        df.tts_xz((x1 + x2) / 2.0, (y1 + y2) / 2.0, obj)
+        emitter.emit(("fog of war",), obj)
 
     if df.config.tts_fog_of_war:
         fog = tts_fog(scaleX=df.width + 2.0, scaleZ=df.height + 2.0)
-        blob["ObjectStates"].append(fog)
-        for x in range(df.width - 1):
-            for y in range(df.height - 1):
-                t = df.tiles[x][y]
-                if not t.blocks_line_of_sight():
-                    continue
-                r = df.tiles[x + 1][y]
-                if r.blocks_line_of_sight() and (t.is_wall() or r.is_wall()):
-                    create_fog_blocker(x + 0.5, y)
-                u = df.tiles[x][y + 1]
-                if u.blocks_line_of_sight() and (t.is_wall() or u.is_wall()):
-                    create_fog_blocker(x, y + 0.5)
+        emitter.emit(("fog of war",), fog)
+        for x1, y1, x2, y2 in fog_blocker_segments(df):
+            create_fog_blocker(x1, y1, x2, y2)
 
     if df.config.tts_hidden_zones:
         fog_bits = {}  # TTSFogBit.coord_tuple():TTSFogBit
@@ -464,7 +1292,21 @@ def dungeon_to_tts_blob(df, name, pdf_filename=None):
             fog_bits[coords] = bit
         merged_bits = TTSFogBit.merge_fog_bits(fog_bits.values())
         for bit in merged_bits:
-            blob["ObjectStates"].append(bit.tts_fog(df))
+            if emitter.use_templates:
+                obj = emitter.emit_templated(
+                    ("hidden zone",),
+                    functools.partial(tts_fog, hidden_zone=True),
+                    **bit.tts_fog_transform(df),
+                )
+            else:
+                obj = bit.tts_fog(df)
+                emitter.emit(("hidden zones",), obj)
+            for roomix in bit.roomixs:
+                group = f"{emitter.group_prefix}{roomix}"
+                emitter.register(obj, ("rooms", group, "zones"))
+            for corridorix in bit.corridorixs:
+                group = f"{emitter.group_prefix}{corridorix}"
+                emitter.register(obj, ("corridors", group, "zones"))
     # Informational PDF
     if pdf_filename:
         obj = reference_object("Reference PDF Document")
@@ -474,45 +1316,234 @@ def dungeon_to_tts_blob(df, name, pdf_filename=None):
         obj["Locked"] = False
         obj["CustomPDF"]["PDFUrl"] = f"file:///{pdf_filename}"
         df.tts_xz(10, -5, obj)
-        blob["ObjectStates"].append(obj)
+        emitter.emit(("pdf",), obj)
     # DM's (hopefully) helpful hidden zone
     dm_fog = tts_fog(scaleX=df.width, scaleZ=20.0, hidden_zone=True)
     df.tts_xz(df.width / 2.0 - 0.5, -10.5, dm_fog)
-    blob["ObjectStates"].append(dm_fog)
-    # Clear scripts if any.
-    for _obj in blob["ObjectStates"]:
-        for obj in recurse_object(_obj):
-            obj["LuaScript"] = ""
-            obj["LuaScriptState"] = ""
-            obj["XmlUI"] = ""
-    # Add HP script carrier.
-    guid = new_tts_guid()
+    emitter.emit(("dm hidden zone",), dm_fog)
+
+
+def _script_carrier(df, description):
+    obj = reference_object("Reference Notecard")
+    obj["Nickname"] = "Caverns of Carl Script Carrier"
+    obj["Description"] = description
+    obj["Transform"]["posY"] = 2.0
+    obj["Locked"] = False
+    df.tts_xz(5, -5, obj)
+    return obj
+
+
+def lua_spawn_queue(objects, references, script_carrier):
+    """Moves objects into a queue for the script carrier to spawn.
+
+    Objects are grouped by the reference object they were copied from:
+    the first of each group is that group's template, and every object
+    is stored as its template's nickname, the fields that differ from
+    the template and the template's fields it lacks. The carrier spawns
+    them a batch per frame, those nearest a ladder up first. Fog of war
+    and hidden zones stay in the save so that nothing is revealed while
+    the rest loads. Returns the objects that stay in the save and the
+    queue to put in the carrier's script state."""
+    static = [script_carrier]
+    spawned = []
+    for obj in objects:
+        if obj is script_carrier:
+            continue
+        if obj["Name"] in ["FogOfWar", "FogOfWarTrigger"]:
+            static.append(obj)
+        else:
+            spawned.append(obj)
+    starts = [
+        (o["Transform"]["posX"], o["Transform"]["posZ"])
+        for o in spawned
+        if o.get("Nickname") == "Ladder up"
+    ] or [(0.0, 0.0)]
+
+    def start_distance(obj):
+        x, z = obj["Transform"]["posX"], obj["Transform"]["posZ"]
+        return min((x - sx) ** 2 + (z - sz) ** 2 for sx, sz in starts)
+
+    spawned.sort(key=start_distance)
+    templates = {}
+    entries = []
+    for obj in spawned:
+        reference = references.get(obj.get("GUID")) or ""
+        template = {}
+        if reference:
+            template = templates.setdefault(reference, obj)
+        delta = {k: v for k, v in obj.items() if template.get(k) != v}
+        removed = [k for k in template if k not in obj]
+        entries.append([reference, delta, removed])
+    queue = {"templates": templates, "objects": entries, "next_ix": 1}
+    return (static, queue)
+
+
+def _set_script_carrier_state(script_carrier, registry, spawn_queue=None):
+    state = {"registry": registry}
+    if spawn_queue is not None:
+        state["spawn"] = spawn_queue
+    script_carrier["LuaScriptState"] = json.dumps(state, separators=(",", ":"))
+
+
+def dungeon_to_tts_blob(df, name, pdf_filename=None):
+    """Builds a TTS save of the floor.
+
+    With tts_incremental_export configured, the floor remembers what it
+    last exported, and exporting it again only produces a patch: a save
+    of the objects that changed, whose script carrier deletes the
+    objects they replace. It's meant to be loaded additively. Floors
+    change by lib.dungeon.reroll_room_encounter, which gives a patch of
+    just that room's objects, or by changing the TTS settings, which
+    are read when the floor is exported. Each export has a new name,
+    so the name is kept out of everything the patch is worked out
+    from; otherwise the script carrier would be replaced every time."""
+    blob = copy.deepcopy(reference_save_json())
+    blob["SaveName"] = name
+    blob["GameMode"] = name
+    blob["ObjectStates"] = []
+    export_id = None
+    old_manifest = None
+    if df.config.tts_incremental_export:
+        if df.tts_export_id is None:
+            df.tts_export_id = new_tts_guid()
+        export_id = df.tts_export_id
+        old_manifest = df.tts_manifest
+    guid = export_id or new_tts_guid()
     name_tag = f"{TTS_SPAWNED_TAG} {guid}"
-    script_carrier = reference_object("Reference Notecard")
-    script_carrier["LuaScript"] = re.sub("REPLACE ME", name_tag, _LUA_SCRIPT)
-    script_carrier["Nickname"] = "Caverns of Carl Script Carrier"
+    transform_digits = None
+    if df.config.tts_compact_encoding:
+        transform_digits = df.config.tts_transform_digits
+    emitter = TTSEmitter(
+        name_tag, export_id=export_id, transform_digits=transform_digits
+    )
+    if export_id is None:
+        _use_fast_paths(emitter, df.config)
+    emit_dungeon_objects(df, name, emitter, pdf_filename=pdf_filename)
+    # Add HP script carrier.
+    script_carrier = _script_carrier(
+        df, f"Associated with dungeon with GUID '{guid}'"
+    )
+    emitter.script_carrier = script_carrier
+    emitter.emit(("script carrier",), script_carrier)
+    emitter.register(script_carrier, ("notecards",))
+    objects, manifest, deleted = emitter.finish(old_manifest)
+    registry = emitter.registry()
+    # Named after finish, so that the name isn't hashed.
     script_carrier["Description"] = (
         f"Associated with dungeon '{name}' with GUID '{guid}'"
     )
-    script_carrier["Transform"]["posY"] = 2.0
-    script_carrier["Locked"] = False
-    df.tts_xz(5, -5, script_carrier)
-    blob["ObjectStates"].append(script_carrier)
-    # Add annotations for future easy mass deletion.
-    for _obj in blob["ObjectStates"]:
-        for obj in recurse_object(_obj):
-            gmnotes = obj.get("GMNotes", "")
-            if gmnotes:
-                gmnotes += "\n\n"
-            gmnotes += name_tag
-            obj["GMNotes"] = gmnotes
+    script_carrier["LuaScript"] = re.sub("REPLACE ME", name_tag, _LUA_SCRIPT)
+    spawn_queue = None
+    if df.config.tts_lua_spawner and old_manifest is None:
+        objects, spawn_queue = lua_spawn_queue(
+            objects, emitter.references, script_carrier
+        )
+    _set_script_carrier_state(script_carrier, registry, spawn_queue)
+    blob["ObjectStates"] = objects
+    if old_manifest is not None:
+        patch_carrier = reference_object("Reference Notecard")
+        patch_carrier["Nickname"] = "Caverns of Carl Patch Carrier"
+        patch_carrier["Description"] = (
+            f"Updates dungeon with GUID '{guid}' to '{name}'"
+        )
+        patch_carrier["Transform"]["posY"] = 2.0
+        patch_carrier["Locked"] = False
+        df.tts_xz(7, -5, patch_carrier)
+        finalize_tts_object(
+            patch_carrier, name_tag, transform_digits=transform_digits
+        )
+        deleted_guids = ", ".join(f'"{g}"' for g in deleted)
+        lua = re.sub("REPLACE GUIDS", deleted_guids, _LUA_PATCH_SCRIPT)
+        carrier_guid = manifest[("script carrier",)][0]
+        lua = re.sub("REPLACE CARRIER", carrier_guid, lua)
+        registry_json = json.dumps(registry, separators=(",", ":"))
+        lua = lua.replace("REPLACE REGISTRY", registry_json)
+        patch_carrier["LuaScript"] = lua
+        blob["ObjectStates"].append(patch_carrier)
+    if manifest is not None:
+        df.tts_manifest = manifest
+    return blob
+
+
+# Tiles of empty table between floors packed into one save.
+_FLOOR_SPACING = 10
+
+
+def dungeons_to_tts_blob(dfs, name, pdf_filenames=None):
+    """Builds one TTS save holding several floors, side by side.
+
+    The first floor sits where dungeon_to_tts_blob would put it, and
+    each later one is shifted along X past the previous one. Every
+    object's GMNotes are tagged with the save's name tag followed by
+    its floor number, so the single script carrier, which matches on
+    the save's tag, covers all of them. Save-wide settings such as the
+    compact encoding come from the first floor's config. Incremental
+    export doesn't apply here: the save always holds everything."""
+    blob = copy.deepcopy(reference_save_json())
+    blob["SaveName"] = name
+    blob["GameMode"] = name
+    guid = new_tts_guid()
+    name_tag = f"{TTS_SPAWNED_TAG} {guid}"
+    transform_digits = None
+    if dfs[0].config.tts_compact_encoding:
+        transform_digits = dfs[0].config.tts_transform_digits
+    emitter = TTSEmitter(name_tag, transform_digits=transform_digits)
+    _use_fast_paths(emitter, dfs[0].config)
+    pdf_filenames = pdf_filenames or [None] * len(dfs)
+    floor_lines = []
+    offset_x = 0.0
+    for ix, (df, pdf_filename) in enumerate(zip(dfs, pdf_filenames)):
+        if ix > 0:
+            offset_x += (dfs[ix - 1].width + df.width) / 2.0 + _FLOOR_SPACING
+        emitter.name_tag = f"{name_tag} floor {ix + 1}"
+        emitter.group_prefix = f"{ix + 1}:"
+        emitter.offset_x = offset_x
+        emit_dungeon_objects(
+            df, f"{name} floor {ix + 1}", emitter, pdf_filename=pdf_filename
+        )
+        floor_lines.append(f"Floor {ix + 1} is centered at X {offset_x:g}.")
+    emitter.name_tag = name_tag
+    emitter.offset_x = 0.0
+    description = "\n".join(
+        [f"Associated with dungeon '{name}' with GUID '{guid}'"] + floor_lines
+    )
+    script_carrier = _script_carrier(dfs[0], description)
+    emitter.script_carrier = script_carrier
+    emitter.emit(("script carrier",), script_carrier)
+    emitter.register(script_carrier, ("notecards",))
+    objects, _, _ = emitter.finish()
+    script_carrier["LuaScript"] = re.sub("REPLACE ME", name_tag, _LUA_SCRIPT)
+    spawn_queue = None
+    if dfs[0].config.tts_lua_spawner:
+        objects, spawn_queue = lua_spawn_queue(
+            objects, emitter.references, script_carrier
+        )
+    _set_script_carrier_state(script_carrier, emitter.registry(), spawn_queue)
+    blob["ObjectStates"] = objects
     return blob
 
 
-def save_tts_blob(blob):
+def encode_tts_blob(blob, compact=False):
+    """Encodes a save as JSON, splicing in any EncodedTTSObjects."""
+    kwargs = {"indent": 2}
+    if compact:
+        kwargs = {"separators": (",", ":")}
+    objects = blob["ObjectStates"]
+    if not any(isinstance(obj, EncodedTTSObject) for obj in objects):
+        return json.dumps(blob, **kwargs)
+    placeholder = f"Object states {new_tts_guid()}"
+    encoded = json.dumps({**blob, "ObjectStates": placeholder}, **kwargs)
+    encoded_objects = ",".join(
+        obj if isinstance(obj, str) else json.dumps(obj, **kwargs)
+        for obj in objects
+    )
+    return encoded.replace(json.dumps(placeholder), f"[{encoded_objects}]")
+
+
+def save_tts_blob(blob, compact=False):
     filename = os.path.join(
         tts_default_save_location(), blob["SaveName"] + ".json"
     )
     with open(filename, "w") as f:
-        json.dump(refresh_tts_guids(blob), f, indent=2)
+        f.write(encode_tts_blob(blob, compact=compact))
     return filename
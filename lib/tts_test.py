@@ -0,0 +1,316 @@
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.append(_ROOT)
+
+import lib.config
+import lib.dungeon
+import lib.meshes
+import lib.tts as tts
+from lib.utils import COC_ROOT_DIR
+
+
+def _fake_object(name, nickname, **extra):
+    obj = {
+        "GUID": "000000",
+        "Name": name,
+        "Nickname": nickname,
+        "Description": "",
+        "GMNotes": "",
+        "Transform": {
+            "posX": 0.0,
+            "posY": 1.0,
+            "posZ": 0.0,
+            "rotX": 0.0,
+            "rotY": 0.0,
+            "rotZ": 0.0,
+            "scaleX": 1.0,
+            "scaleY": 1.0,
+            "scaleZ": 1.0,
+        },
+        "ColorDiffuse": {"r": 0.5, "g": 0.5, "b": 0.5},
+        "Locked": True,
+        "LuaScript": "",
+        "LuaScriptState": "",
+        "XmlUI": "",
+    }
+    obj.update(extra)
+    return obj
+
+
+class _FakeReferenceObjects(dict):
+    """Stands in for the TTS reference save, which isn't in the repo,
+    making up a plausible object for any nickname."""
+
+    def __contains__(self, nickname):
+        return True
+
+    def __missing__(self, nickname):
+        mesh = {
+            "MeshURL": f"mesh://{nickname}",
+            "DiffuseURL": f"diffuse://{nickname}",
+            "NormalURL": "",
+        }
+        if nickname == "REFERENCE NOTECARD":
+            obj = _fake_object("Notecard", nickname)
+        elif nickname.startswith(("CHEST", "BOOKSHELF")):
+            obj = _fake_object("Custom_Model", nickname, CustomMesh=mesh)
+            opened = _fake_object(
+                "Custom_Model",
+                nickname,
+                CustomMesh=mesh,
+                ChildObjects=[_fake_object("Figurine", "")],
+            )
+            obj["States"] = {"2": opened}
+        elif nickname == "HORN CANDLE SCONCE" or nickname.startswith(
+            "BLUE MUSH"
+        ):
+            obj = _fake_object(
+                "Custom_Model",
+                nickname,
+                CustomMesh=mesh,
+                ChildObjects=[_fake_object("Light", "")],
+            )
+        else:
+            obj = _fake_object("Custom_Model", nickname, CustomMesh=mesh)
+        self[nickname] = obj
+        return obj
+
+
+_FAKE_SAVE = {
+    "SaveName": "",
+    "GameMode": "",
+    "ObjectStates": [
+        _fake_object("FogOfWar", "", FogOfWar={"Height": 2.0}),
+        _fake_object("FogOfWarTrigger", "", FogColor="Black"),
+    ],
+}
+_real_reference_functions = {}
+
+
+def setUpModule():
+    for name in ["reference_save_json", "reference_objects"]:
+        _real_reference_functions[name] = getattr(tts, name)
+    tts.reference_save_json = lambda: _FAKE_SAVE
+    references = _FakeReferenceObjects()
+    tts.reference_objects = lambda: references
+
+
+def tearDownModule():
+    for name, f in _real_reference_functions.items():
+        setattr(tts, name, f)
+
+
+def _make_floor(seed, **config):
+    random.seed(seed)
+    c = lib.config.DungeonConfig()
+    for k, v in config.items():
+        setattr(c, k, v)
+    return lib.dungeon.generate_random_dungeon(c)
+
+
+def _all_objects(objects):
+    """Yields objects and everything nested in them."""
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        yield obj
+        stack += obj.get("ContainedObjects", [])
+        stack += obj.get("ChildObjects", [])
+        stack += list(obj.get("States", {}).values())
+
+
+def _decoded_blob(blob):
+    return json.loads(tts.encode_tts_blob(blob))
+
+
+def _carrier_state(objects):
+    for obj in objects:
+        if obj.get("Nickname") == "Caverns of Carl Script Carrier":
+            return json.loads(obj["LuaScriptState"])
+    raise AssertionError("No script carrier")
+
+
+class TestDungeonToTTSBlob(unittest.TestCase):
+    def test_notecards_registered(self):
+        for config in [{}, {"tts_incremental_export": True}]:
+            df = _make_floor(3, **config)
+            objects = _decoded_blob(tts.dungeon_to_tts_blob(df, "test"))[
+                "ObjectStates"
+            ]
+            registered = set(_carrier_state(objects)["registry"]["notecards"])
+            notecards = [
+                obj["GUID"]
+                for obj in _all_objects(objects)
+                if obj["Name"] == "Notecard"
+            ]
+            self.assertGreater(len(notecards), 1)
+            self.assertEqual(set(notecards) - registered, set())
+
+    def test_patch_keeps_script_carrier(self):
+        df = _make_floor(3, tts_incremental_export=True)
+        tts.dungeon_to_tts_blob(df, "first")
+        blob = tts.dungeon_to_tts_blob(df, "second")
+        nicknames = [obj["Nickname"] for obj in blob["ObjectStates"]]
+        self.assertEqual(nicknames, ["Caverns of Carl Patch Carrier"])
+        # Changed settings are what make a patch.
+        df.config.tts_notecards = False
+        blob = tts.dungeon_to_tts_blob(df, "third")
+        nicknames = [obj["Nickname"] for obj in blob["ObjectStates"]]
+        self.assertNotIn("Caverns of Carl Script Carrier", nicknames)
+        self.assertIn("Caverns of Carl Patch Carrier", nicknames)
+        lua = blob["ObjectStates"][-1]["LuaScript"]
+        self.assertNotIn("DELETED_GUIDS = {}", lua)
+
+    def test_rerolled_encounter_patch(self):
+        df = _make_floor(3, tts_incremental_export=True)
+        old_objects = tts.dungeon_to_tts_blob(df, "first")["ObjectStates"]
+        room = next(room for room in df.rooms if room.encounter)
+        old_guids = {
+            obj["GUID"]
+            for obj in old_objects
+            if obj["Nickname"].endswith(
+                tuple(m.monster_info.name for m in room.encounter.monsters)
+            )
+        }
+        self.assertTrue(old_guids)
+        random.seed(4)
+        encounter = lib.dungeon.reroll_room_encounter(df, room)
+        self.assertIsNotNone(encounter)
+        for monster in df.monsters:
+            self.assertEqual(
+                df.monster_locations[(monster.x, monster.y)], monster
+            )
+        objects = tts.dungeon_to_tts_blob(df, "second")["ObjectStates"]
+        patch_carrier = objects.pop()
+        self.assertEqual(
+            patch_carrier["Nickname"], "Caverns of Carl Patch Carrier"
+        )
+        # Only the room's monsters and notecard are replaced.
+        monster_names = {m.monster_info.name for m in encounter.monsters}
+        for obj in objects:
+            name = obj["Nickname"].split(" ", 1)[-1]
+            self.assertTrue(
+                name in monster_names or obj["Nickname"] == room.name(),
+                obj["Nickname"],
+            )
+        for guid in old_guids:
+            self.assertIn(f'"{guid}"', patch_carrier["LuaScript"])
+
+    def test_spawned_notecards_known_by_guid(self):
+        # The spawner hides registered notecards as they spawn, going by
+        # the GUID in their spawn data.
+        df = _make_floor(3, tts_lua_spawner=True)
+        objects = _decoded_blob(tts.dungeon_to_tts_blob(df, "test"))[
+            "ObjectStates"
+        ]
+        state = _carrier_state(objects)
+        queue = state["spawn"]
+        spawned = {}
+        for reference, delta, removed in queue["objects"]:
+            data = dict(queue["templates"].get(reference, {}))
+            data.update(delta)
+            for k in removed:
+                data.pop(k, None)
+            spawned[data["GUID"]] = data
+        static = {obj["GUID"] for obj in objects}
+        for guid in state["registry"]["notecards"]:
+            if guid not in static:
+                self.assertEqual(spawned[guid]["Name"], "Notecard")
+
+    def test_tile_bands_independent_of_start_method(self):
+        df = _make_floor(3)
+        emitter = tts.TTSEmitter("test")
+        emitter.tile_workers = 2
+        tasks = tts._tile_band_tasks(df, emitter, set())
+        # Spawned workers first: bands built here add their GUIDs to
+        # those seen, which workers are handed.
+        spawned = tts._encode_tile_bands(
+            df,
+            tasks,
+            workers=2,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self.assertEqual(spawned, tts._encode_tile_bands(df, tasks))
+
+
+class TestRangedTTSGUID(unittest.TestCase):
+    def test_range_used_up(self):
+        lo = 0xABC000
+        guids = {tts.ranged_tts_guid(lo, lo + 64) for _ in range(64)}
+        self.assertEqual(guids, {f"{n:x}" for n in range(lo, lo + 64)})
+        with self.assertRaises(RuntimeError):
+            tts.ranged_tts_guid(lo, lo + 64)
+
+    def test_bands_share_guid_space(self):
+        df = _make_floor(3)
+        emitter = tts.TTSEmitter("test")
+        emitter.tile_workers = 2
+        ranges = sorted(
+            task[6] for task in tts._tile_band_tasks(df, emitter, set())
+        )
+        self.assertEqual(ranges[0][0], 16**5)
+        for (_, hi), (lo, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(hi, lo)
+        self.assertGreater(ranges[-1][1], 16**6 - len(ranges))
+        self.assertLessEqual(ranges[-1][1], 16**6)
+
+
+class TestCombinedMeshes(unittest.TestCase):
+    def test_stale_meshes_removed_and_caverns_kept(self):
+        name = "combined meshes test"
+        mesh_dir = os.path.join(COC_ROOT_DIR, "output", "meshes", name)
+        os.makedirs(mesh_dir, exist_ok=True)
+        stale = os.path.join(mesh_dir, "999999.obj")
+        with open(stale, "w") as f:
+            f.write("")
+        try:
+            df = _make_floor(3)
+            meshes, baked = lib.meshes.combined_mesh_objects(df, name)
+            self.assertFalse(os.path.exists(stale))
+            self.assertTrue(baked)
+            for x, y in baked:
+                tile = df.tiles[x][y]
+                if tile.is_wall():
+                    self.assertNotEqual(tile.tile_style, "cavern")
+            for obj in meshes:
+                self.assertIs(obj["CustomMesh"]["Convex"], False)
+            # Each baked tile's notes are those of a mesh over it.
+            notes = {obj["GMNotes"] for obj in meshes}
+            for x, y in baked:
+                tile = df.tiles[x][y]
+                self.assertFalse(tile.trapixs)
+                self.assertIn(tile._tts_gmnotes(df), notes)
+        finally:
+            shutil.rmtree(mesh_dir, ignore_errors=True)
+
+
+class TestDungeonsToTTSBlob(unittest.TestCase):
+    def test_floors_packed(self):
+        dfs = [_make_floor(3), _make_floor(4)]
+        blob = _decoded_blob(tts.dungeons_to_tts_blob(dfs, "test"))
+        objects = blob["ObjectStates"]
+        guids = [obj["GUID"] for obj in _all_objects(objects)]
+        self.assertEqual(len(guids), len(set(guids)))
+        # (min X, max X) of each floor's objects
+        floor_xs = []
+        for ix in range(len(dfs)):
+            xs = [
+                obj["Transform"]["posX"]
+                for obj in objects
+                if obj.get("GMNotes", "").endswith(f" floor {ix + 1}")
+            ]
+            self.assertTrue(xs)
+            floor_xs.append((min(xs), max(xs)))
+        self.assertLess(floor_xs[0][1], floor_xs[1][0])
+
+
+if __name__ == "__main__":
+    unittest.main()
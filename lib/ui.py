@@ -59,6 +59,7 @@ def set_tk_text(tk_text, s, default_tag_kwargs={}, style_newlines=False):
 def run_ui():
     config = lib.config.DungeonConfig()
     dungeon_history = []
+    kept_floors = []  # floors picked for Save Kept Floors to TTS
 
     root = tk.Tk()
     root.title("Caverns of Carl")
@@ -105,50 +106,59 @@ def run_ui():
             config_notebook.select(len(config.biomes))
 
     def new_preview(*args, **kwargs):
-        set_tk_text(ascii_map_text, "")
-        set_tk_text(chest_info_text, "")
-
-        text_output = []
         err = None
         try:
             config.load_from_tk_entries()
             df = lib.dungeon.generate_random_dungeon(config)
             dungeon_history.append(df)
+        except Exception as e:
+            err = traceback.format_exc()
+        show_dungeon(err)
 
-            text_output.append("Floor monster counts:")
-            text_output.append(lib.monster.summarize_monsters(df.monsters))
-            text_output.append("")
-            total_xp = 0
-            for room in df.rooms:
-                if room.encounter:
-                    total_xp += room.encounter.total_xp()
-            xp_per_player = int(total_xp / config.num_player_characters)
-            text_output.append(
-                f"Total floor encounter xp: ~{total_xp:,} (~{xp_per_player:,} per player)"
-            )
-            text_output.append("")
-            rooms = [r for r in df.rooms if r.name_num is not None]
-            for room in sorted(rooms, key=lambda r: r.name_num):
-                if room.is_trivial():
-                    continue
-                doc = room.description(df, verbose=True)
-                text_output.append(f"***{doc.flat_header()}***")
-                text_output.append(doc.flat_body(separator="\n\n"))
-                text_output.append("")
-            for corridor in sorted(df.corridors, key=lambda x: x.name or ""):
-                if not corridor.is_nontrivial(df):
-                    continue
-                doc = corridor.description(df, verbose=True)
-                text_output.append(f"***{doc.flat_header()}***")
-                text_output.append(doc.flat_body(separator="\n\n"))
+    def show_dungeon(err=None):
+        set_tk_text(ascii_map_text, "")
+        set_tk_text(chest_info_text, "")
+
+        text_output = []
+        if err is None:
+            try:
+                df = dungeon_history[-1]
+                text_output.append("Floor monster counts:")
+                text_output.append(lib.monster.summarize_monsters(df.monsters))
                 text_output.append("")
-            for npc in sorted(df.npcs, key=lambda x: x.name):
-                doc = npc.doc()
-                text_output.append(f"***{doc.flat_header()}***")
-                text_output.append(doc.flat_body(separator="\n\n"))
+                total_xp = 0
+                for room in df.rooms:
+                    if room.encounter:
+                        total_xp += room.encounter.total_xp()
+                xp_per_player = int(total_xp / config.num_player_characters)
+                text_output.append(
+                    f"Total floor encounter xp: ~{total_xp:,} (~{xp_per_player:,} per player)"
+                )
                 text_output.append("")
-        except Exception as e:
-            err = traceback.format_exc()
+                rooms = [r for r in df.rooms if r.name_num is not None]
+                for room in sorted(rooms, key=lambda r: r.name_num):
+                    if room.is_trivial():
+                        continue
+                    doc = room.description(df, verbose=True)
+                    text_output.append(f"***{doc.flat_header()}***")
+                    text_output.append(doc.flat_body(separator="\n\n"))
+                    text_output.append("")
+                for corridor in sorted(
+                    df.corridors, key=lambda x: x.name or ""
+                ):
+                    if not corridor.is_nontrivial(df):
+                        continue
+                    doc = corridor.description(df, verbose=True)
+                    text_output.append(f"***{doc.flat_header()}***")
+                    text_output.append(doc.flat_body(separator="\n\n"))
+                    text_output.append("")
+                for npc in sorted(df.npcs, key=lambda x: x.name):
+                    doc = npc.doc()
+                    text_output.append(f"***{doc.flat_header()}***")
+                    text_output.append(doc.flat_body(separator="\n\n"))
+                    text_output.append("")
+            except Exception as e:
+                err = traceback.format_exc()
         if err:
             text_output = [err]
         else:
@@ -164,6 +174,32 @@ def run_ui():
             {"foreground": "#fff", "background": "#000"},
         )
 
+    def reroll_encounter(*args, **kwargs):
+        if not dungeon_history:
+            return
+        text_output = ["\n"]
+        try:
+            config.load_from_tk_entries()
+            df = dungeon_history[-1]
+            name_num = int(reroll_room_entry.get())
+            rooms = [r for r in df.rooms if r.name_num == name_num]
+            if not rooms:
+                raise ValueError(f"There's no room {name_num} on this floor.")
+            encounter = lib.dungeon.reroll_room_encounter(df, rooms[0])
+            show_dungeon()
+            if encounter is None:
+                text_output.append(f"Room {name_num} now has no encounter.")
+            else:
+                text_output.append(f"Rerolled room {name_num}'s encounter.")
+            if config.tts_incremental_export and df.tts_manifest is not None:
+                text_output.append(
+                    "Save to TTS again for a patch that only replaces that room."
+                )
+        except Exception as e:
+            text_output.append(traceback.format_exc())
+        chest_info_text.insert(tk.END, StyledString("\n").join(text_output))
+        chest_info_text.see(tk.END)
+
     def save_dungeon(*args, **kwargs):
         if not dungeon_history:
             return
@@ -182,9 +218,74 @@ def run_ui():
                 text_output.append(
                     "The python library `pdflab` is not installed, so no PDF information document will be created."
                 )
+            is_patch = (
+                config.tts_incremental_export and df.tts_manifest is not None
+            )
             blob = tts.dungeon_to_tts_blob(df, name, pdf_filename=pdf_filename)
-            tts_filename = tts.save_tts_blob(blob)
+            tts_filename = tts.save_tts_blob(
+                blob, compact=config.tts_compact_encoding
+            )
             text_output.append(f"Saved TTS file to {tts_filename}")
+            if is_patch:
+                text_output.append(
+                    "It only holds what changed since the last save of this floor; load it with Additive Load on top of that save."
+                )
+            elif config.tts_incremental_export:
+                text_output.append(
+                    "To patch this save, reroll an encounter or change TTS settings, then save this floor again."
+                )
+        except Exception as e:
+            text_output.append("\n")
+            text_output.append(traceback.format_exc())
+        chest_info_text.insert(tk.END, StyledString("\n").join(text_output))
+        chest_info_text.see(tk.END)
+
+    def keep_dungeon(*args, **kwargs):
+        if not dungeon_history:
+            return
+        df = dungeon_history[-1]
+        if df in kept_floors:
+            text = f"\nThis floor is already kept, as floor {kept_floors.index(df) + 1}."
+        else:
+            kept_floors.append(df)
+            text = f"\nKept this floor as floor {len(kept_floors)}, for Save Kept Floors to TTS."
+        chest_info_text.insert(tk.END, text)
+        chest_info_text.see(tk.END)
+
+    def save_kept_dungeons(*args, **kwargs):
+        if not kept_floors:
+            chest_info_text.insert(
+                tk.END,
+                "\nNo floors kept yet; click Keep Floor on each floor to save.",
+            )
+            chest_info_text.see(tk.END)
+            return
+        text_output = ["\n"]
+        try:
+            config.load_from_tk_entries()
+            now = datetime.datetime.now()
+            name = f"Caverns of Carl {now:%Y-%m-%dT%H-%M-%S%z}"
+            pdf_filenames = []
+            for ix, df in enumerate(kept_floors):
+                pdf_filenames.append(
+                    lib.pdf.produce_pdf_if_possible(
+                        df, f"{name} floor {ix + 1}"
+                    )
+                )
+            num_pdfs = len([x for x in pdf_filenames if x])
+            if num_pdfs:
+                text_output.append(
+                    f"Created {num_pdfs} PDF information documents"
+                )
+            blob = tts.dungeons_to_tts_blob(
+                kept_floors, name, pdf_filenames=pdf_filenames
+            )
+            tts_filename = tts.save_tts_blob(
+                blob, compact=kept_floors[0].config.tts_compact_encoding
+            )
+            text_output.append(
+                f"Saved the {len(kept_floors)} kept floors, side by side, to {tts_filename}"
+            )
         except Exception as e:
             text_output.append("\n")
             text_output.append(traceback.format_exc())
@@ -204,6 +305,25 @@ def run_ui():
         operation_frame, text="Save to TTS", command=save_dungeon
     )
     save_button.grid(row=0, column=2)
+    keep_button = tk.Button(
+        operation_frame, text="Keep Floor", command=keep_dungeon
+    )
+    keep_button.grid(row=0, column=3)
+    save_kept_button = tk.Button(
+        operation_frame,
+        text="Save Kept Floors to TTS",
+        command=save_kept_dungeons,
+    )
+    save_kept_button.grid(row=0, column=4)
+    reroll_frame = tk.Frame(operation_frame)
+    tk.Label(reroll_frame, text="Room #").pack(side=tk.LEFT)
+    reroll_room_entry = tk.Entry(reroll_frame, width=4)
+    reroll_room_entry.pack(side=tk.LEFT)
+    reroll_button = tk.Button(
+        reroll_frame, text="Reroll Encounter", command=reroll_encounter
+    )
+    reroll_button.pack(side=tk.LEFT)
+    reroll_frame.grid(row=1, column=0, columnspan=5)
     operation_frame.pack(pady=10)
 
     ascii_map_label = tk.Label(middle_frame, text="ASCII Map")
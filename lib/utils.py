@@ -1,4 +1,5 @@
 import functools
+import heapq
 import math
 import os
 import random
@@ -72,77 +73,38 @@ def samples(seq, k=1, weights=None):
         yield value
 
 
-class BNFRule:
-    def expression(self):
-        "[rule, rule, rule, ...]"
-        raise NotImplementedError()
-
-    def parse(self, tokens):
-        rules = self.expression()
-        return self._parse_tokens_with_rules(tokens, rules)
-
-    def _parse_tokens_with_rules(self, tokens, rules):
-        if len(tokens) < len(rules):
-            return None
-        if len(rules) == 1:
-            p = rules[0].parse(tokens)
-            if p:
-                return [p]
-            else:
-                return None
-        for ix in range(1, len(tokens) - len(rules) + 2):
-            p0 = rules[0].parse(tokens[:ix])
-            if not p0:
-                continue
-            pn = self._parse_tokens_with_rules(tokens[ix:], rules[1:])
-            if pn:
-                return [p0] + pn
-        return None
-
-    def __repr__(self):
-        return str(self.__class__)
-
-
-class LiteralRule(BNFRule):
-    def __init__(self, literal):
-        self.literal = literal
-
-    def parse(self, tokens):
-        if len(tokens) == 1 and tokens[0] == self.literal:
-            return self
-        return None
-
-    def __repr__(self):
-        return f"L('{self.literal}')"
-
-
-class EitherRule(BNFRule):
-    def __init__(self, rule_options):
-        self.rule_options = list(rule_options)
+def binomial(n, p):
+    """How many of n trials, each with chance p, succeed; drawn by
+    inverting the distribution with a single random number."""
+    if p <= 0.0:
+        return 0
+    if p >= 1.0:
+        return n
+    u = random.random()
+    q = 1.0 - p
+    pmf = q**n
+    cdf = pmf
+    k = 0
+    while u > cdf and k < n:
+        pmf *= (n - k) / (k + 1) * p / q
+        k += 1
+        cdf += pmf
+    return k
+
+
+class KeywordExprRule:
+    """A node of a parsed keyword expression; see parse_keyword_expr."""
 
-    def parse(self, tokens):
-        for rule in self.rule_options:
-            p = rule.parse(tokens)
-            if p:
-                return p
-        return None
-
-    def __repr__(self):
-        return f"EitherRule({', '.join([repr(x) for x in self.rule_options])})"
+    def match(self, keywords):
+        raise NotImplementedError()
 
 
-class NonSpecialTokensRule(BNFRule):
+class NonSpecialTokensRule(KeywordExprRule):
     def __init__(self, tokens=None):
         self.keyword = None
         if tokens:
             self.keyword = " ".join(tokens)
 
-    def parse(self, tokens):
-        for token in tokens:
-            if token in {"(", ")", "OR", "AND", "NOT"}:
-                return None
-        return NonSpecialTokensRule(tokens)
-
     def match(self, keywords):
         return self.keyword in keywords or not self.keyword
 
@@ -150,19 +112,10 @@ class NonSpecialTokensRule(BNFRule):
         return f"'{self.keyword}'"
 
 
-class NotRule(BNFRule):
+class NotRule(KeywordExprRule):
     def __init__(self, internal_rule=None):
         self.internal_rule = internal_rule
 
-    def expression(self):
-        return [LiteralRule("NOT"), KeywordExprRule()]
-
-    def parse(self, tokens):
-        p = super().parse(tokens)
-        if not p:
-            return None
-        return NotRule(p[1])
-
     def match(self, keywords):
         return not self.internal_rule.match(keywords)
 
@@ -170,19 +123,10 @@ class NotRule(BNFRule):
         return f"NotRule({self.internal_rule})"
 
 
-class OrRule(BNFRule):
+class OrRule(KeywordExprRule):
     def __init__(self, left=None, right=None):
         self.left, self.right = left, right
 
-    def expression(self):
-        return [KeywordExprRule(), LiteralRule("OR"), KeywordExprRule()]
-
-    def parse(self, tokens):
-        p = super().parse(tokens)
-        if not p:
-            return None
-        return OrRule(p[0], p[2])
-
     def match(self, keywords):
         return self.left.match(keywords) or self.right.match(keywords)
 
@@ -190,19 +134,10 @@ class OrRule(BNFRule):
         return f"OrRule({self.left}, {self.right})"
 
 
-class AndRule(BNFRule):
+class AndRule(KeywordExprRule):
     def __init__(self, left=None, right=None):
         self.left, self.right = left, right
 
-    def expression(self):
-        return [KeywordExprRule(), LiteralRule("AND"), KeywordExprRule()]
-
-    def parse(self, tokens):
-        p = super().parse(tokens)
-        if not p:
-            return None
-        return AndRule(p[0], p[2])
-
     def match(self, keywords):
         return self.left.match(keywords) and self.right.match(keywords)
 
@@ -210,49 +145,206 @@ class AndRule(BNFRule):
         return f"AndRule({self.left}, {self.right})"
 
 
-class ParensRule(BNFRule):
-    def expression(self):
-        return [LiteralRule("("), KeywordExprRule(), LiteralRule(")")]
+_KEYWORD_EXPR_SPECIAL_TOKENS = {"(", ")", "OR", "AND", "NOT"}
+# operator -> (precedence, rule class); NOT binds tightest
+_KEYWORD_EXPR_OPERATORS = {
+    "OR": (1, OrRule),
+    "AND": (2, AndRule),
+    "NOT": (3, NotRule),
+}
 
-    def parse(self, tokens):
-        p = super().parse(tokens)
-        if not p:
-            return None
-        return p[1]
-
-
-class KeywordExprRule(EitherRule):
-    def __init__(self):
-        super().__init__(
-            [
-                ParensRule(),
-                OrRule(),
-                AndRule(),
-                NotRule(),
-                NonSpecialTokensRule(),
-            ]
-        )
 
-    def __repr__(self):
-        return "KeywordExprRule"
+def _parse_keyword_tokens(tokens):
+    """Parses tokens into a rule tree in one pass (shunting-yard), or
+    returns None if they aren't a valid expression.
+
+    Runs of other tokens are multiword keywords, and NOT binds tighter
+    than AND, which binds tighter than OR. AND and OR group to the
+    right."""
+    if not tokens:
+        return NonSpecialTokensRule()
+    operands = []
+    operators = []  # "(" or keys of _KEYWORD_EXPR_OPERATORS
+
+    def reduce():
+        op = operators.pop()
+        if op == "NOT":
+            operands.append(NotRule(operands.pop()))
+        else:
+            right = operands.pop()
+            left = operands.pop()
+            operands.append(_KEYWORD_EXPR_OPERATORS[op][1](left, right))
+
+    ix = 0
+    expect_operand = True
+    while ix < len(tokens):
+        token = tokens[ix]
+        if expect_operand:
+            if token in {"(", "NOT"}:
+                operators.append(token)
+                ix += 1
+            elif token in _KEYWORD_EXPR_SPECIAL_TOKENS:
+                return None
+            else:
+                end = ix
+                while (
+                    end < len(tokens)
+                    and tokens[end] not in _KEYWORD_EXPR_SPECIAL_TOKENS
+                ):
+                    end += 1
+                operands.append(NonSpecialTokensRule(tokens[ix:end]))
+                ix = end
+                expect_operand = False
+        elif token == ")":
+            while operators and operators[-1] != "(":
+                reduce()
+            if not operators:
+                return None
+            operators.pop()
+            ix += 1
+        elif token in {"AND", "OR"}:
+            precedence = _KEYWORD_EXPR_OPERATORS[token][0]
+            while (
+                operators
+                and operators[-1] != "("
+                and _KEYWORD_EXPR_OPERATORS[operators[-1]][0] > precedence
+            ):
+                reduce()
+            operators.append(token)
+            expect_operand = True
+            ix += 1
+        else:
+            return None
+    if expect_operand:
+        return None
+    while operators:
+        if operators[-1] == "(":
+            return None
+        reduce()
+    return operands[0]
 
 
 @functools.cache
 def parse_keyword_expr(s):
     tokens = re.split("([() ])", s.upper().strip())
     tokens = [x.strip() for x in tokens if x.strip()]
-    return KeywordExprRule().parse(tokens)
+    return _parse_keyword_tokens(tokens)
+
+
+# A compiled keyword expression's program pushes a keyword's operand
+# for each of its indexes, which are nonnegative, and otherwise these.
+_KEYWORD_OP_EVERYTHING = -1
+_KEYWORD_OP_NOT = -2
+_KEYWORD_OP_AND = -3
+_KEYWORD_OP_OR = -4
+_KEYWORD_RULE_OPS = {
+    NotRule: _KEYWORD_OP_NOT,
+    AndRule: _KEYWORD_OP_AND,
+    OrRule: _KEYWORD_OP_OR,
+}
+
+
+class CompiledKeywordExpr:
+    """A parsed keyword expression flattened into a postfix program
+    over its keywords, so that evaluating it is one loop rather than a
+    walk of the rule tree.
+
+    Sets of items are ints with a bit set for every item in them. The
+    program computes the set of items matching, given as operands the
+    set of items having each keyword, in the order of self.keywords:
+    a library's keyword bitsets to filter all of its items at once, or
+    1 or 0 to test a single item."""
+
+    def __init__(self, rule):
+        self.keywords = []  # uppercase keywords, by operand index
+        self.keyword_ixs = {}
+        self.program = []
+        stack = [(rule, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if isinstance(node, NonSpecialTokensRule):
+                if not node.keyword:
+                    self.program.append(_KEYWORD_OP_EVERYTHING)
+                    continue
+                ix = self.keyword_ixs.get(node.keyword)
+                if ix is None:
+                    ix = len(self.keywords)
+                    self.keywords.append(node.keyword)
+                    self.keyword_ixs[node.keyword] = ix
+                self.program.append(ix)
+            elif children_done:
+                self.program.append(_KEYWORD_RULE_OPS[type(node)])
+            elif isinstance(node, NotRule):
+                stack += [(node, True), (node.internal_rule, False)]
+            else:
+                stack += [
+                    (node, True),
+                    (node.right, False),
+                    (node.left, False),
+                ]
+
+    def evaluate(self, operands, everything):
+        stack = []
+        for op in self.program:
+            if op >= 0:
+                stack.append(operands[op])
+            elif op == _KEYWORD_OP_AND:
+                right = stack.pop()
+                stack[-1] &= right
+            elif op == _KEYWORD_OP_OR:
+                right = stack.pop()
+                stack[-1] |= right
+            elif op == _KEYWORD_OP_NOT:
+                stack[-1] = everything & ~stack[-1]
+            else:
+                stack.append(everything)
+        return stack[-1]
+
+    def match_bitsets(self, bitsets, everything):
+        """The items matching, where bitsets maps uppercase keywords to
+        the items having them and everything is the set of all items."""
+        return self.evaluate(
+            [bitsets.get(keyword, 0) for keyword in self.keywords],
+            everything,
+        )
+
+    def match(self, keywords):
+        """Whether an item with keywords, in any case, matches."""
+        operands = [0] * len(self.keywords)
+        for keyword in keywords:
+            ix = self.keyword_ixs.get(keyword.upper())
+            if ix is not None:
+                operands[ix] = 1
+        return self.evaluate(operands, 1) == 1
+
+
+@functools.cache
+def compile_keyword_expr(expr):
+    """The CompiledKeywordExpr of a keyword expression string or parsed
+    expression, or None if it isn't valid."""
+    if isinstance(expr, str):
+        expr = parse_keyword_expr(expr)
+    if expr is None:
+        return None
+    return CompiledKeywordExpr(expr)
 
 
 def expr_match_keywords(expr, keywords):
     if not expr:
         return True
-    keywords = {x.upper() for x in keywords}
-    if isinstance(expr, str):
-        if not expr.strip():  # Blank matches everything.
-            return True
-        expr = parse_keyword_expr(expr)
-    return expr.match(keywords)
+    if isinstance(expr, str) and not expr.strip():  # Blank matches everything.
+        return True
+    return compile_keyword_expr(expr).match(keywords)
+
+
+def expr_match_bitsets(expr, bitsets, everything):
+    """expr_match_keywords for many items at once; see
+    CompiledKeywordExpr.match_bitsets."""
+    if not expr:
+        return everything
+    if isinstance(expr, str) and not expr.strip():  # Blank matches everything.
+        return everything
+    return compile_keyword_expr(expr).match_bitsets(bitsets, everything)
 
 
 def eval_dice(e):
@@ -335,6 +427,92 @@ def neighbor_coords(x, y, cardinal=True, diagonal=False):
         yield (x + dx, y + dy)
 
 
+def label_grid_rectangles(labels, width, priorities=None):
+    """Covers a row-major grid of labels with few same-label rectangles.
+
+    labels[x + y * width] is the label of cell (x, y), or None if the
+    cell needn't be covered. Greedily takes the largest remaining
+    rectangle first, using a heap of candidate rectangles anchored at
+    their lower left cell; ties go to the anchor with the higher
+    priority. Returns a list of inclusive (label, x1, y1, x2, y2)
+    tuples."""
+    labels = list(labels)
+    height = len(labels) // width
+    # cell -> number of consecutive same-label cells starting at the
+    # cell and going right.
+    runs = [0] * len(labels)
+    for y in range(height):
+        row = y * width
+        for c in range(row + width - 1, row - 1, -1):
+            label = labels[c]
+            if label is None:
+                continue
+            if c + 1 < row + width and labels[c + 1] == label:
+                runs[c] = runs[c + 1] + 1
+            else:
+                runs[c] = 1
+
+    def largest_at(c):
+        label = labels[c]
+        best = (0, 0, 0)  # area, width, height
+        w = runs[c]
+        h = 0
+        while w > 0:
+            h += 1
+            if w * h > best[0]:
+                best = (w * h, w, h)
+            above = c + h * width
+            if above >= len(labels) or labels[above] != label:
+                break
+            w = min(w, runs[above])
+        return best
+
+    def candidate(c):
+        priority = priorities[c] if priorities else 0
+        return (-largest_at(c)[0], -priority, c)
+
+    # Only cells with no same-label cell to their left or below can
+    # anchor a maximal rectangle; more become anchors as cells go.
+    heap = []
+    for c, label in enumerate(labels):
+        if label is None:
+            continue
+        if c % width and labels[c - 1] == label:
+            if c >= width and labels[c - width] == label:
+                continue
+        heap.append(candidate(c))
+    heapq.heapify(heap)
+    output = []
+    while heap:
+        neg_area, neg_priority, c = heapq.heappop(heap)
+        label = labels[c]
+        if label is None:
+            continue
+        area, w, h = largest_at(c)
+        if area != -neg_area:
+            # stale candidate; try again later with its current size
+            heapq.heappush(heap, (-area, neg_priority, c))
+            continue
+        x, y = c % width, c // width
+        for row in range(c, c + h * width, width):
+            for tc in range(row, row + w):
+                labels[tc] = None
+                runs[tc] = 0
+            for tc in range(row - 1, row - x - 1, -1):
+                if labels[tc] != label:
+                    break
+                runs[tc] = row - tc
+            if x + w < width and labels[row + w] is not None:
+                heapq.heappush(heap, candidate(row + w))
+        above = c + h * width
+        if above < len(labels):
+            for tc in range(above, above + w):
+                if labels[tc] is not None:
+                    heapq.heappush(heap, candidate(tc))
+        output.append((label, x, y, x + w - 1, y + h - 1))
+    return output
+
+
 @functools.total_ordering
 class CharStyle:
     def __init__(self, r, g, b, *, is_bold=False, is_underline=False):
@@ -0,0 +1,37 @@
+"""
+Times parsing long keyword filter expressions, which used to take
+exponential time. Run directly: python lib/utils_bench.py
+"""
+
+import os
+import sys
+import timeit
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.append(_ROOT)
+
+from lib.utils import parse_keyword_expr
+
+_REPEATS = 20
+
+
+def _expressions():
+    others = " or ".join(f"thing{i}" for i in range(300))
+    return {
+        "300 terms": f"(undead or construct) and not ({others})",
+        "300 deep": "(" * 300 + "not " * 300 + "undead" + ")" * 300,
+    }
+
+
+def main():
+    for label, expr in _expressions().items():
+        # parse_keyword_expr caches, so time the parse underneath it.
+        seconds = timeit.timeit(
+            lambda: parse_keyword_expr.__wrapped__(expr), number=_REPEATS
+        )
+        print(f"{label}: {seconds / _REPEATS * 1000:.2f} ms per parse")
+
+
+if __name__ == "__main__":
+    main()
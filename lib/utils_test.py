@@ -1,13 +1,25 @@
+import contextlib
 import functools
 import os
 import sys
 import unittest
+from unittest import mock
 
 _ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 if _ROOT not in sys.path:
     sys.path.append(_ROOT)
 
-from lib.utils import expr_match_keywords, parse_keyword_expr
+from lib.utils import (
+    AndRule,
+    NonSpecialTokensRule,
+    NotRule,
+    OrRule,
+    compile_keyword_expr,
+    expr_match_bitsets,
+    expr_match_keywords,
+    label_grid_rectangles,
+    parse_keyword_expr,
+)
 
 
 class CustomExprParseAssertions:
@@ -96,6 +108,143 @@ class TestExprParse(unittest.TestCase, CustomExprParseAssertions):
         self.assertNotMatches(expr, ["hobgoblinoid", "goblinoid"])
         self.assertNotMatches(expr, ["bugbearoid", "goblinoid"])
 
+    def test_long_expressions(self):
+        # These took exponential time to parse by trying every split.
+        # Timings are in utils_bench.py; here, parsing must build only
+        # the rule nodes that end up in the tree, no more of them than
+        # there are words, nested no deeper than the expression is.
+        others = " or ".join(f"thing{i}" for i in range(300))
+        expr = f"(undead or construct) and not ({others})"
+        deep = "(" * 300 + "not " * 300 + "undead" + ")" * 300
+        for s, depth in [(expr, 302), (deep, 301)]:
+            with contextlib.ExitStack() as stack:
+                inits = [
+                    stack.enter_context(
+                        mock.patch.object(
+                            cls, "__init__", autospec=True, side_effect=init
+                        )
+                    )
+                    for cls, init in _rule_inits()
+                ]
+                rule = parse_keyword_expr.__wrapped__(s)
+            nodes = list(_rule_nodes(rule))
+            self.assertEqual(sum(i.call_count for i in inits), len(nodes))
+            self.assertLessEqual(len(nodes), len(s.split()))
+            self.assertEqual(max(d for _, d in nodes), depth)
+        self.assertMatches(expr, ["undead"])
+        self.assertNotMatches(expr, ["undead", "thing299"])
+        self.assertNotMatches(expr, ["thing7"])
+        self.assertMatches(deep, ["undead"])
+        self.assertIsNone(parse_keyword_expr(expr + " and"))
+        self.assertIsNone(parse_keyword_expr(deep + ")"))
+
+
+class TestCompiledKeywordExpr(unittest.TestCase):
+    ITEMS = [
+        ["Undead", "Urban"],
+        ["Construct", "Flesh Golem"],
+        ["Construct", "Urban"],
+        ["Beast"],
+        [],
+    ]
+
+    def test_bitsets_match_items(self):
+        bitsets = {}
+        for ix, keywords in enumerate(self.ITEMS):
+            for keyword in keywords:
+                bitsets[keyword.upper()] = bitsets.get(keyword.upper(), 0)
+                bitsets[keyword.upper()] |= 1 << ix
+        everything = (1 << len(self.ITEMS)) - 1
+        for expr in [
+            "",
+            "undead",
+            "flesh golem or not (construct or beast)",
+            "not not urban and (undead or construct)",
+            "not (beast or undead) and not urban",
+            "dragon",
+        ]:
+            expected = 0
+            for ix, keywords in enumerate(self.ITEMS):
+                if expr_match_keywords(expr, keywords):
+                    expected |= 1 << ix
+            self.assertEqual(
+                expr_match_bitsets(expr, bitsets, everything), expected, expr
+            )
+
+    def test_cached(self):
+        expr = "undead and not urban"
+        self.assertIs(compile_keyword_expr(expr), compile_keyword_expr(expr))
+        self.assertEqual(
+            compile_keyword_expr(expr).keywords, ["UNDEAD", "URBAN"]
+        )
+        self.assertIsNone(compile_keyword_expr("undead and"))
+
+
+def _rule_inits():
+    """(rule class, its __init__) for every kind of rule node."""
+    return [
+        (cls, cls.__init__)
+        for cls in [NonSpecialTokensRule, NotRule, OrRule, AndRule]
+    ]
+
+
+def _rule_nodes(rule):
+    """Yields (node, depth) for every node of a rule tree."""
+    stack = [(rule, 1)]
+    while stack:
+        node, depth = stack.pop()
+        yield (node, depth)
+        for attr in ["internal_rule", "left", "right"]:
+            child = getattr(node, attr, None)
+            if child is not None:
+                stack.append((child, depth + 1))
+
+
+class TestLabelGridRectangles(unittest.TestCase):
+    def assertPartitions(self, labels, width, rects):
+        covered = [None] * len(labels)
+        for label, x1, y1, x2, y2 in rects:
+            for x in range(x1, x2 + 1):
+                for y in range(y1, y2 + 1):
+                    self.assertIsNone(covered[x + y * width])
+                    covered[x + y * width] = label
+        self.assertEqual(covered, labels)
+
+    def test_single_label(self):
+        labels = [7] * 12
+        rects = label_grid_rectangles(labels, 4)
+        self.assertEqual(rects, [(7, 0, 0, 3, 2)])
+
+    def test_l_shape(self):
+        # fmt: off
+        labels = [
+            1, 1, 1,
+            1, None, None,
+            1, None, None,
+        ]
+        # fmt: on
+        rects = label_grid_rectangles(labels, 3)
+        self.assertEqual(len(rects), 2)
+        self.assertPartitions(labels, 3, rects)
+
+    def test_labels_kept_apart(self):
+        # fmt: off
+        labels = [
+            1, 1, 2, 2,
+            1, 1, 2, 2,
+            3, 3, 3, 3,
+        ]
+        # fmt: on
+        rects = label_grid_rectangles(labels, 4)
+        self.assertEqual(len(rects), 3)
+        self.assertPartitions(labels, 4, rects)
+
+    def test_checkerboard(self):
+        labels = [(x + y) % 2 for y in range(5) for x in range(6)]
+        rects = label_grid_rectangles(labels, 6)
+        self.assertEqual(len(rects), 30)
+        self.assertPartitions(labels, 6, rects)
+
 
 if __name__ == "__main__":
     unittest.main()